@@ -1,19 +1,69 @@
 """
 .. include:: README.md
 """
+import argparse
+import asyncio
+import binascii
+import collections
+import concurrent.futures
+import copy
 import datetime
 import email.header
+import getpass
 import imaplib
+import itertools
+import json
 import logging
 import mailbox
 import os
 import re
+import sqlite3
+import ssl
+import threading
 import time
+import weakref
+import zlib
+
+__all__ = [
+    "IMAPMailbox",
+    "IMAPMessage",
+    "IMAPMessageHeadersOnly",
+    "IMAPMessageLazy",
+    "IMAPMessageProxy",
+    "IMAPConnectionPool",
+    "AsyncIMAPMailbox",
+    "RetryPolicy",
+    "HeaderCache",
+    "MessageCache",
+]
+
+FETCH_TOKEN_RE = re.compile(
+    rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?))'
+)
+LITERAL_RE = re.compile(rb"~?\{(\d+)\+?\}$")
+RESPONSE_RE = re.compile(rb"(\S+) (?:(\d+) )?(\S+) ?(.*)$", re.S)
+RESPONSE_CODE_RE = re.compile(rb"\[([^\s\]]+) ?([^\]]*)\]")
+UID_COMMANDS = ("SEARCH", "FETCH", "STORE", "COPY", "MOVE")
+PARTIAL_RE = re.compile(r"\]<\d+\.\d+>")
+BASE64_JUNK_RE = re.compile(rb"[^A-Za-z0-9+/=]")
+FOLDER_DATA_RE = re.compile(r"\(([^)]+)\) \"([^\"]+)\" \"?([^\"]+)\"?$")
+MAILDIR_FLAGS = {
+    "\\Seen": "S",
+    "\\Answered": "R",
+    "\\Flagged": "F",
+    "\\Deleted": "T",
+    "\\Draft": "D",
+}
 
-__all__ = ["IMAPMailbox", "IMAPMessage", "IMAPMessageHeadersOnly"]
 
-MESSAGE_HEAD_RE = re.compile(r"(\d+) \(([^\s]+) {(\d+)}$")
-FOLDER_DATA_RE = re.compile(r"\(([^)]+)\) \"([^\"]+)\" \"?([^\"]+)\"?$")
+# imaplib does not know about the COMPRESS extension (RFC 4978)
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
+
+# imaplib creates a new SSL context for every connection, connections share
+# this one by default so their TLS sessions can be resumed
+DEFAULT_SSL_CONTEXT = ssl._create_stdlib_context()
+# the last TLS session per SSL context and (host, port)
+TLS_SESSIONS = weakref.WeakKeyDictionary()
 
 
 log = logging.getLogger(__name__)
@@ -29,6 +79,293 @@ def handle_response(response):
     return data
 
 
+def parse_fetch_response(data):
+    """Parse the data of a FETCH response
+
+    `data` is the list returned by imaplib, where a piece followed by a literal
+    is a (head, literal) tuple. Any mix of data items is supported, including
+    several literals per message, nested lists like FLAGS or BODYSTRUCTURE and
+    NIL values.
+
+    Yields a tuple of message number and a dict that maps the upper-cased data
+    item names to their values. Numbers are converted to int, NIL to None,
+    lists to lists, literals are bytes and everything else is a str.
+    Example: (1, {"UID": 10, "FLAGS": ["\\Seen"], "RFC822": b"..."})
+    """
+
+    tokens = []
+    depth = 0
+    for piece in data:
+        if piece is None:
+            continue
+
+        literal = None
+        if isinstance(piece, tuple):
+            piece, literal = piece
+            size = LITERAL_RE.search(piece)
+            if int(size.group(1)) != len(literal):
+                raise Exception("Size mismatch")
+            piece = piece[: size.start()]
+
+        for match in FETCH_TOKEN_RE.finditer(piece):
+            opening, closing, quoted, atom = match.groups()
+            if opening:
+                depth += 1
+                tokens.append(("(", None))
+            elif closing:
+                depth -= 1
+                tokens.append((")", None))
+            elif quoted is not None:
+                quoted = re.sub(rb"\\(.)", rb"\1", quoted)
+                tokens.append(("string", quoted.decode("utf-8", "surrogateescape")))
+            elif atom is not None:
+                tokens.append(("atom", atom.decode("utf-8", "surrogateescape")))
+
+        if literal is not None:
+            tokens.append(("literal", literal))
+
+        if depth == 0 and tokens:
+            items = _parse_fetch_value(tokens, 1)[0]
+            yield int(tokens[0][1]), {
+                str(name).upper(): value for name, value in zip(items[::2], items[1::2])
+            }
+            tokens = []
+
+
+def _parse_fetch_value(tokens, pos):
+    """Parse the value that starts at `pos`, return the value and the next position"""
+
+    kind, value = tokens[pos]
+    if kind == "(":
+        values = []
+        pos += 1
+        while tokens[pos][0] != ")":
+            value, pos = _parse_fetch_value(tokens, pos)
+            values.append(value)
+        return values, pos + 1
+
+    if kind == "atom":
+        if value.upper() == "NIL":
+            value = None
+        elif value.isdigit():
+            value = int(value)
+
+    return value, pos + 1
+
+
+def fetch_body(items):
+    """Get the message body from the data items of a parsed FETCH response
+
+    Returns the value of the first RFC822, BODY[...] or BINARY[...] item as
+    bytes, or None if the response carries none of them.
+    """
+
+    for name, value in items.items():
+        if name == "RFC822.SIZE" or not name.startswith(("RFC822", "BODY[", "BINARY[")):
+            continue
+        if value is None:
+            return b""
+        if isinstance(value, str):
+            return value.encode("utf-8", "surrogateescape")
+        return value
+
+    return None
+
+
+def bodystructure_str(value):
+    """Convert a BODYSTRUCTURE string, which may come as a literal, to str"""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def bodystructure_parts(structure):
+    """Get the subparts of a multipart BODYSTRUCTURE, they are the leading lists"""
+    return list(itertools.takewhile(lambda part: isinstance(part, list), structure))
+
+
+def bodystructure_params(params):
+    """Convert a BODYSTRUCTURE parameter list to a dict of MIME parameters"""
+    if not params:
+        return {}
+    params = [bodystructure_str(value) for value in params]
+    return {name.lower(): value for name, value in zip(params[::2], params[1::2])}
+
+
+def decode_transfer_encoding(chunks, encoding):
+    """Decode chunks of a base64 or quoted-printable payload incrementally
+
+    Only complete base64 quanta and complete quoted-printable lines are decoded
+    from each chunk, the rest is carried over to the next one. Other encodings
+    are passed through unchanged.
+    """
+
+    encoding = (encoding or "7bit").lower()
+    pending = b""
+
+    if encoding == "base64":
+        for chunk in chunks:
+            pending += BASE64_JUNK_RE.sub(b"", chunk)
+            end = len(pending) - len(pending) % 4
+            if end:
+                yield binascii.a2b_base64(pending[:end])
+                pending = pending[end:]
+
+        if pending:
+            # be lenient with missing padding, like the email package
+            yield binascii.a2b_base64(pending + b"=" * (-len(pending) % 4))
+
+    elif encoding == "quoted-printable":
+        for chunk in chunks:
+            pending += chunk
+            end = pending.rfind(b"\n") + 1
+            if end:
+                yield binascii.a2b_qp(pending[:end])
+                pending = pending[end:]
+
+        if pending:
+            yield binascii.a2b_qp(pending)
+
+    else:
+        yield from chunks
+
+
+class DeflateIO:
+    """Compressed I/O for an imaplib connection, see RFC 4978
+
+    Replaces the `read`, `readline` and `send` methods of the connection with
+    versions that inflate everything read from the socket and deflate
+    everything written to it, using raw deflate streams.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+        )
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = bytearray()
+
+        connection.read = self.read
+        connection.readline = self.readline
+        connection.send = self.send
+
+    def fill(self) -> bool:
+        """Read and inflate more data, return False at the end of the stream"""
+
+        data = self.connection.file.read1(64 * 1024)
+        if not data:
+            return False
+
+        self.buffer += self.decompressor.decompress(data)
+        return True
+
+    def read(self, size):
+        """Read `size` bytes"""
+
+        while len(self.buffer) < size and self.fill():
+            pass
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self):
+        """Read a line"""
+
+        while b"\n" not in self.buffer and self.fill():
+            pass
+
+        return self.read(self.buffer.find(b"\n") + 1 or len(self.buffer))
+
+    def send(self, data):
+        """Send data"""
+
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.connection.sock.sendall(data)
+
+
+class TLSSessionContext:
+    """An SSL context that resumes the last TLS session to the same server
+
+    imaplib only passes `server_hostname` to `wrap_socket`, this passes the
+    session remembered for `address` too and records the handshake time in
+    the `metrics` dict.
+    """
+
+    def __init__(self, context, address, metrics):
+        self.context = context
+        self.address = address
+        self.metrics = metrics
+
+    def wrap_socket(self, sock, server_hostname=None):
+        """Wrap a socket, resuming the last session when possible"""
+
+        session = TLS_SESSIONS.get(self.context, {}).get(self.address)
+        start = time.perf_counter()
+        sock = self.context.wrap_socket(
+            sock, server_hostname=server_hostname, session=session
+        )
+        elapsed = time.perf_counter() - start
+
+        self.metrics["handshakes"] += 1
+        self.metrics["resumed"] += sock.session_reused
+        self.metrics["handshake_seconds"] += elapsed
+        resumed = "resumed" if sock.session_reused else "full"
+        log.info(f"TLS handshake ({resumed}) took {elapsed * 1000:.1f} ms")
+        return sock
+
+    def remember(self, sock):
+        """Remember the session of a connected socket for the next connection"""
+
+        # TLS 1.3 sends session tickets after the handshake, so this is only
+        # called once the server has answered a command
+        session = getattr(sock, "session", None)
+        if session is not None:
+            TLS_SESSIONS.setdefault(self.context, {})[self.address] = session
+
+
+class RepeatingTimer(threading.Thread):
+    """Call a function every `interval` seconds in a daemon thread until stopped"""
+
+    def __init__(self, interval, function):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.function = function
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.function()
+            except Exception:
+                log.exception(f"{self.function.__name__} failed")
+
+    def stop(self):
+        """Stop calling the function, a call in progress is finished"""
+        self.stopped.set()
+
+
+class RetryPolicy:
+    """How often, and how long to wait before, reconnecting a dropped connection
+
+    The delay starts at `backoff` seconds and doubles after every failed
+    attempt, up to `max_backoff` seconds. After `attempts` failed attempts in a
+    row the connection error is raised.
+    """
+
+    def __init__(self, attempts=5, backoff=1.0, max_backoff=60.0):
+        """Create a new RetryPolicy object"""
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delays(self):
+        """Yield the delay before each reconnection attempt"""
+        for attempt in range(self.attempts):
+            yield min(self.backoff * 2**attempt, self.max_backoff)
+
+
 def change_time(time, weeks=0, days=0, hours=0, minutes=0, seconds=0):
     """Change the time by a given amount of days, hours, minutes and seconds"""
     return time + datetime.timedelta(
@@ -46,9 +383,148 @@ def imap_date_range(start, end):
     return f"(SINCE {imap_date(start)} BEFORE {imap_date(end)})"
 
 
+def expand_search_macros(query) -> str:
+    """Expand search macros in the query."""
+
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+
+    week_start = today - datetime.timedelta(days=today.weekday())
+    last_week_start = week_start - datetime.timedelta(days=7)
+
+    month_start = datetime.date(today.year, today.month, 1)
+    year_start = datetime.date(today.year, 1, 1)
+
+    if today.month == 1:  # January
+        # last month is December of the previous year
+        last_month_start = datetime.date(today.year - 1, 12, 1)
+    else:
+        last_month_start = datetime.date(today.year, today.month - 1, 1)
+
+    last_year_start = datetime.date(today.year - 1, 1, 1)
+
+    q = query
+    q = q.replace("FIND", "TEXT")
+
+    q = q.replace("TODAY", f"ON {imap_date(today)}")
+    q = q.replace("YESTERDAY", f"ON {imap_date(yesterday)}")
+
+    q = q.replace("THISWEEK", f"SINCE {imap_date(week_start)}")
+    q = q.replace("THISMONTH", f"SINCE {imap_date(month_start)}")
+    q = q.replace("THISYEAR", f"SINCE {imap_date(year_start)}")
+
+    q = q.replace("LASTWEEK", imap_date_range(last_week_start, week_start))
+    q = q.replace("LASTMONTH", imap_date_range(last_month_start, month_start))
+    q = q.replace("LASTYEAR", imap_date_range(last_year_start, year_start))
+
+    # shortcuts
+    q = q.replace("PASTDAY", "PAST1DAY")
+    q = q.replace("PASTWEEK", "PAST1WEEK")
+    q = q.replace("PASTMONTH", "PAST1MONTH")
+    q = q.replace("PASTYEAR", "PAST1YEAR")
+
+    # use regex to match the PASTXDAYS macro
+    q = re.sub(
+        r"PAST(\d+)DAYS?",
+        lambda m: f"SINCE {imap_date(change_time(today, days=-int(m.group(1))))}",
+        q,
+    )
+
+    # use regex to match the PASTXWEEKS macro
+    q = re.sub(
+        r"PAST(\d+)WEEKS?",
+        lambda m: f"SINCE {imap_date(change_time(today, weeks=-int(m.group(1))))}",
+        q,
+    )
+
+    # use regex to match the PASTXMONTHS macro
+    q = re.sub(
+        r"PAST(\d+)MONTHS?",
+        lambda m: f"SINCE {imap_date(change_time(today, days=-int(m.group(1)) * 30))}",
+        q,
+    )
+
+    # use regex to match the PASTXYEARS macro
+    q = re.sub(
+        r"PAST(\d+)YEARS?",
+        lambda m: f"SINCE {imap_date(change_time(today, days=-int(m.group(1)) * 365))}",
+        q,
+    )
+
+    return q
+
+
+def imap_quote(value):
+    """Quote a string for use as an IMAP command argument"""
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{value}"'
+
+
+def headers_fetch_item(fields=None):
+    """Get the FETCH data item for the message headers
+
+    When a list of header `fields` is given only those are requested, using
+    BODY.PEEK[HEADER.FIELDS (...)]. Otherwise all headers are requested.
+    """
+    if not fields:
+        return "RFC822.HEADER"
+    return f"BODY.PEEK[HEADER.FIELDS ({' '.join(fields).upper()})]"
+
+
+def maildir_flags(flags) -> str:
+    """Map IMAP flags to Maildir flags, unknown flags are dropped"""
+    return "".join(MAILDIR_FLAGS[flag] for flag in flags if flag in MAILDIR_FLAGS)
+
+
+def chunked(items, size):
+    """Split a list of items into lists of at most `size` items"""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def sequence_set(uids) -> bytes:
+    """Build a compact IMAP sequence set from a list of message numbers
+
+    Runs of consecutive numbers are collapsed into ranges.
+    Example: ["1", "2", "3", "5"] becomes b"1:3,5".
+    """
+
+    ranges = []
+    for uid in map(int, uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ",".join(
+        str(start) if start == end else f"{start}:{end}" for start, end in ranges
+    ).encode()
+
+
+def parse_sequence_set(text) -> list[str]:
+    """Expand an IMAP sequence set into a list of message numbers
+
+    This is the inverse of `sequence_set`.
+    Example: b"1:3,5" becomes ["1", "2", "3", "5"].
+    """
+
+    if isinstance(text, bytes):
+        text = text.decode()
+
+    numbers = []
+    for item in filter(None, text.split(",")):
+        start, _, end = item.partition(":")
+        start, end = sorted((int(start), int(end or start)))
+        numbers.extend(map(str, range(start, end + 1)))
+
+    return numbers
+
+
 class IMAPMessage(mailbox.Message):
     """A Mailbox Message class that uses an IMAPClient object to fetch the message"""
 
+    __decoded = None
+
     @classmethod
     def from_uid(cls, uid, mailbox):
         """Create a new message from a UID"""
@@ -63,6 +539,10 @@ class IMAPMessage(mailbox.Message):
         This method overrides the default implementation of accessing a message headers.
         The header is decoded using the email.header.decode_header method. This allows
         for the retrieval of headers that contain non-ASCII characters.
+
+        Decoded values are memoized by their raw value, so changing a header
+        never returns a stale value. Values without encoded words are returned
+        as they are.
         """
 
         original_header = super().__getitem__(name)
@@ -70,6 +550,22 @@ class IMAPMessage(mailbox.Message):
         if original_header is None:
             return None
 
+        if not isinstance(original_header, str):
+            return self.__decode(original_header)
+
+        if "=?" not in original_header:
+            return original_header
+
+        if self.__decoded is None:
+            self.__decoded = {}
+        if original_header not in self.__decoded:
+            self.__decoded[original_header] = self.__decode(original_header)
+        return self.__decoded[original_header]
+
+    @staticmethod
+    def __decode(original_header):
+        """Decode the encoded words of a header value"""
+
         decoded_pairs = email.header.decode_header(original_header)
         decoded_chunks = []
         for data, charset in decoded_pairs:
@@ -91,46 +587,870 @@ class IMAPMessageHeadersOnly(IMAPMessage):
     """A Mailbox Message class that uses an IMAPClient object to fetch the message"""
 
     @classmethod
-    def from_uid(cls, uid, mailbox):
-        """Create a new message from a UID"""
+    def from_uid(cls, uid, mailbox, fields=None):
+        """Create a new message from a UID
+
+        Only the header `fields` are fetched when given, otherwise the
+        mailbox `header_fields` setting is used.
+        """
 
         # fetch headers only message from the mailbox
-        uid, body = next(mailbox.fetch(uid, "RFC822.HEADER"))
+        what = headers_fetch_item(fields or mailbox.header_fields)
+        uid, body = next(mailbox.fetch(uid, what))
         return cls(body)
 
 
+class IMAPMessageLazy(IMAPMessage):
+    """A Mailbox Message class that fetches MIME parts only when they are needed
+
+    Only the headers and the BODYSTRUCTURE of the message are fetched up front.
+    The MIME tree is built from the BODYSTRUCTURE, and the payload of each part
+    is fetched with BODY.PEEK[section] the first time `get_payload()` is called
+    on it. Walking the message with `walk()` does not fetch anything, so
+    attachments are never downloaded unless their payload is accessed.
+    """
+
+    section = None
+    """The IMAP section of this part, like "1" or "2.1", or "TEXT" for the body
+    of a single part message. None for multipart containers."""
+
+    size = None
+    """The size in bytes of the encoded payload, as reported by BODYSTRUCTURE"""
+
+    __mailbox = None
+    __uid = None
+
+    @classmethod
+    def from_uid(cls, uid, mailbox):
+        """Create a new message from a UID"""
+
+        # fetch the headers and the MIME structure of the message
+        number, items = next(
+            mailbox.fetch_items(uid, "(UID BODY.PEEK[HEADER] BODYSTRUCTURE)")
+        )
+        message = cls(items["BODY[HEADER]"])
+        message.__build(items["BODYSTRUCTURE"], uid, mailbox, "")
+        return message
+
+    def __build(self, structure, uid, mailbox, section):
+        """Set up this part and its subparts from a BODYSTRUCTURE"""
+
+        if isinstance(structure[0], list):
+            # multipart: (part1 part2 ... subtype params disposition ...)
+            parts = bodystructure_parts(structure)
+            subparts = []
+            for number, part_structure in enumerate(parts, 1):
+                part = self.__class__()
+                part.__set_part_headers(part_structure)
+                part.__build(
+                    part_structure,
+                    uid,
+                    mailbox,
+                    f"{section}.{number}" if section else str(number),
+                )
+                subparts.append(part)
+
+            self.set_payload(subparts)
+            return
+
+        self.section = section or "TEXT"
+        self.size = structure[6]
+        self.__uid = uid
+        self.__mailbox = mailbox
+
+    def __set_part_headers(self, structure):
+        """Set the MIME headers of a subpart from its BODYSTRUCTURE"""
+
+        if isinstance(structure[0], list):
+            subtype = structure[len(bodystructure_parts(structure))]
+            extension = structure[len(bodystructure_parts(structure)) + 1 :]
+            params = extension[0] if extension else None
+            self.add_header(
+                "Content-Type",
+                f"multipart/{bodystructure_str(subtype).lower()}",
+                **bodystructure_params(params),
+            )
+            disposition = extension[1] if len(extension) > 1 else None
+        else:
+            maintype, subtype, params, content_id, description, encoding = (
+                bodystructure_str(value) if not isinstance(value, list) else value
+                for value in structure[:6]
+            )
+            content_type = f"{maintype}/{subtype}".lower()
+            self.add_header(
+                "Content-Type", content_type, **bodystructure_params(params)
+            )
+            if content_id:
+                self["Content-ID"] = content_id
+            if description:
+                self["Content-Description"] = description
+            if encoding:
+                self["Content-Transfer-Encoding"] = encoding.lower()
+
+            # the extension data follows the type specific fields
+            if maintype.lower() == "text":
+                extension = structure[8:]
+            elif content_type == "message/rfc822":
+                extension = structure[10:]
+            else:
+                extension = structure[7:]
+            disposition = extension[1] if len(extension) > 1 else None
+
+        if disposition:
+            self.add_header(
+                "Content-Disposition",
+                bodystructure_str(disposition[0]).lower(),
+                **bodystructure_params(disposition[1]),
+            )
+
+    def get_payload(self, i=None, decode=False):
+        """Get the payload, fetching it from the server on first access"""
+
+        if self.__mailbox is not None:
+            what = f"BODY.PEEK[{self.section}]"
+            fetched = self.__mailbox.fetch(self.__uid, what)
+            body = b"".join(body for uid, body in fetched)
+            self.set_payload(body.decode("ascii", "surrogateescape"))
+            # only forget the mailbox once the payload is loaded, so a failed
+            # fetch is retried on the next access
+            self.__mailbox = None
+
+        return super().get_payload(i, decode)
+
+
+class IMAPMessageProxy:
+    """A lazy stand-in for a message in the mailbox
+
+    A proxy knows its UID and the cheap metadata from the listing FETCH: size,
+    flags and internal date. Headers are fetched the first time they are
+    accessed, together with the headers of every other proxy from the same
+    listing batch that does not have them yet. The full message is fetched
+    the first time `message` is accessed, or an attribute of the message like
+    `get_payload` is used on the proxy. With the mailbox's `prefetch_bytes`,
+    the following messages of the batch are fetched along, up to that size.
+    Bodies are fetched with BODY.PEEK[], so they are not marked as seen.
+    """
+
+    def __init__(self, uid, mailbox, batch, size=None, flags=None, internaldate=None):
+        self.uid = uid
+        self.size = size
+        self.flags = flags
+        self.internaldate = internaldate
+        self.__mailbox = mailbox
+        self.__batch = batch
+        self.__headers = None
+        self.__message = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} uid={self.uid} size={self.size}>"
+
+    @property
+    def headers(self) -> IMAPMessageHeadersOnly:
+        """Get the headers only message, fetching the headers of the batch"""
+
+        if self.__headers is None:
+            pending = {
+                proxy.uid: proxy for proxy in self.__batch if proxy.__headers is None
+            }
+            pending[self.uid] = self
+
+            what = headers_fetch_item(self.__mailbox.header_fields)
+            uids = sequence_set(sorted(pending, key=int))
+            for uid, body in self.__mailbox.fetch(uids, what):
+                if uid in pending:
+                    pending[uid].__headers = IMAPMessageHeadersOnly(body)
+
+        return self.__headers
+
+    @property
+    def message(self) -> IMAPMessage:
+        """Get the full message, fetching it on first access"""
+
+        if self.__message is None:
+            pending = {self.uid: self}
+            total = 0
+            following = self.__batch[self.__batch.index(self) + 1 :]
+            for proxy in following:
+                if proxy.__message is not None:
+                    continue
+                total += proxy.size or 0
+                if total > (self.__mailbox.prefetch_bytes or 0):
+                    break
+                pending[proxy.uid] = proxy
+
+            uids = sequence_set(sorted(pending, key=int))
+            for uid, body in self.__mailbox.fetch(uids, "BODY.PEEK[]"):
+                if uid in pending:
+                    pending[uid].__message = IMAPMessage(body)
+
+        return self.__message
+
+    def __getitem__(self, name: str):
+        """Get a decoded message header"""
+        return self.headers[name]
+
+    def get(self, name: str, failobj=None):
+        """Get a decoded message header, or `failobj` if it is missing"""
+        value = self.headers[name]
+        return failobj if value is None else value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+
+class IMAPConnectionPool:
+    """A pool of authenticated IMAP connections shared by IMAPMailbox objects
+
+    Pass the same pool to several `IMAPMailbox` objects. Their `connect()`
+    checks out an idle connection that is already logged in, preferably one
+    that already has the requested folder selected, and `disconnect()` returns
+    it to the pool instead of logging out.
+
+    At most `max_per_account` connections are open for the same host, port and
+    user, and at most `max_per_host` for the same host and port. When a limit is
+    reached `acquire()` waits up to `timeout` seconds for a connection to be
+    released, idle connections of other accounts on the host are closed to make
+    room.
+
+    With an `idle_timeout`, connections that stay idle in the pool for longer
+    than that many seconds are logged out by a background thread, so they do
+    not hold on to connection slots on the server.
+
+    Connections that were idle for more than `check_after` seconds are sent a
+    NOOP when checked out, dead ones are dropped instead of handed out.
+    """
+
+    def __init__(
+        self,
+        max_per_host=10,
+        max_per_account=4,
+        timeout=None,
+        idle_timeout=None,
+        check_after=30.0,
+    ):
+        """Create a new IMAPConnectionPool object"""
+        self.max_per_host = max_per_host
+        self.max_per_account = max_per_account
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.__lock = threading.Condition()
+        self.__idle = collections.defaultdict(list)
+        self.__open_per_account = collections.Counter()
+        self.__open_per_host = collections.Counter()
+        self.__reaper = None
+
+        if idle_timeout is not None:
+            self.__reaper = RepeatingTimer(idle_timeout / 2, self.reap)
+            self.__reaper.start()
+
+    def acquire(self, account, connect, folder=None):
+        """Check out a connection for an account
+
+        `account` is a (host, port, user) tuple and `connect` is called without
+        arguments to open and log in a new connection when no idle one can be
+        reused.
+
+        Returns:
+            tuple: The connection and the state dict it was released with
+        """
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            entry = self.__checkout(account, folder, deadline)
+            if entry is None:
+                break
+            if self.__alive(*entry):
+                return entry
+
+            log.info(f"Dropping dead pooled connection for {account}")
+            self.__logout(entry[0])
+            self.__forget(account)
+
+        try:
+            return connect(), {}
+        except BaseException:
+            self.__forget(account)
+            raise
+
+    def release(self, account, connection, state=None, discard=False):
+        """Return a connection to the pool
+
+        `state` is handed back by `acquire()` the next time the connection is
+        checked out. Broken connections should be released with `discard=True`,
+        they are closed instead of being reused.
+        """
+
+        if discard:
+            self.__logout(connection)
+            self.__forget(account)
+            return
+
+        state = dict(state or {}, released=time.monotonic())
+        with self.__lock:
+            self.__idle[account].append((connection, state))
+            self.__lock.notify()
+
+    def reap(self):
+        """Log out connections that have been idle for longer than `idle_timeout`"""
+
+        if self.idle_timeout is None:
+            return
+
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.__lock:
+            expired = [
+                (account, entry)
+                for account, entries in self.__idle.items()
+                for entry in entries
+                if entry[1]["released"] < cutoff
+            ]
+            for account, entry in expired:
+                self.__idle[account].remove(entry)
+
+        if expired:
+            log.info(f"Closing {len(expired)} idle pooled connections")
+        for account, (connection, state) in expired:
+            self.__logout(connection)
+            self.__forget(account)
+
+    def close(self):
+        """Log out all idle connections and stop reaping them"""
+
+        if self.__reaper is not None:
+            self.__reaper.stop()
+
+        with self.__lock:
+            idle = [
+                (account, entry)
+                for account, entries in self.__idle.items()
+                for entry in entries
+            ]
+            self.__idle.clear()
+
+        for account, (connection, state) in idle:
+            self.__logout(connection)
+            self.__forget(account)
+
+    def __checkout(self, account, folder, deadline):
+        """Take an idle connection out of the pool, or room for a new one
+
+        Returns the (connection, state) entry of an idle connection, or None
+        when the caller may open a new connection.
+        """
+
+        stale = []
+        try:
+            with self.__lock:
+                while True:
+                    idle = self.__idle[account]
+                    if idle:
+                        # prefer a connection that already has the folder selected
+                        matching = [
+                            entry for entry in idle if entry[1].get("folder") == folder
+                        ]
+                        entry = (matching or idle)[-1]
+                        idle.remove(entry)
+                        return entry
+
+                    if self.__has_room(account):
+                        break
+
+                    stale = self.__evict(account)
+                    if stale:
+                        continue
+
+                    remaining = (
+                        None if deadline is None else deadline - time.monotonic()
+                    )
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(
+                            f"No IMAP connection available for {account}"
+                        )
+                    self.__lock.wait(remaining)
+
+                self.__open_per_account[account] += 1
+                self.__open_per_host[account[:2]] += 1
+        finally:
+            for connection, state in stale:
+                self.__logout(connection)
+
+        return None
+
+    def __alive(self, connection, state):
+        """Check with a NOOP that a connection idle for `check_after` still works"""
+
+        if time.monotonic() - state["released"] < self.check_after:
+            return True
+
+        try:
+            connection.noop()
+        except (imaplib.IMAP4.error, OSError):
+            return False
+        return True
+
+    def __has_room(self, account):
+        """Check the connection limits for an account"""
+        return (
+            self.__open_per_account[account] < self.max_per_account
+            and self.__open_per_host[account[:2]] < self.max_per_host
+        )
+
+    def __evict(self, account):
+        """Take idle connections of other accounts on the same host out of the pool"""
+
+        if self.__open_per_account[account] >= self.max_per_account:
+            return []
+
+        for other, entries in self.__idle.items():
+            if other != account and other[:2] == account[:2] and entries:
+                self.__open_per_account[other] -= 1
+                self.__open_per_host[other[:2]] -= 1
+                return [entries.pop(0)]
+
+        return []
+
+    def __forget(self, account):
+        """Stop counting a connection that was closed"""
+
+        with self.__lock:
+            self.__open_per_account[account] -= 1
+            self.__open_per_host[account[:2]] -= 1
+            self.__lock.notify()
+
+    def __logout(self, connection):
+        """Log out a connection, ignoring errors from broken ones"""
+
+        try:
+            connection.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+
+class HeaderCache:
+    """An on-disk cache of message headers, stored in an SQLite database
+
+    Headers are stored by host, user, folder, UIDVALIDITY and UID, and by the
+    header fields that were fetched. Headers never change, so they stay valid
+    until the folder's UIDVALIDITY changes, at which point every header cached
+    for the folder is dropped. Flags are not cached since they do change.
+
+    Pass the same cache to any number of `IMAPMailbox` objects, it can be used
+    from several threads.
+    """
+
+    def __init__(self, path):
+        """Create a new HeaderCache object, `path` is the SQLite database file"""
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        with self.__db:
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                "host TEXT, user TEXT, folder TEXT, uidvalidity INTEGER, "
+                "uid INTEGER, what TEXT, headers BLOB, "
+                "PRIMARY KEY (host, user, folder, uidvalidity, uid, what))"
+            )
+
+    def get(self, folder, what, uids) -> dict:
+        """Get the cached headers of messages in a folder
+
+        `folder` is a (host, user, folder, uidvalidity) tuple, headers cached
+        with a different UIDVALIDITY are dropped. `what` is the FETCH item the
+        headers were fetched with.
+
+        Returns:
+            dict: The headers of the cached UIDs, in the order of `uids`
+        """
+
+        rows = {}
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "DELETE FROM headers "
+                "WHERE host = ? AND user = ? AND folder = ? AND uidvalidity != ?",
+                folder,
+            )
+            # stay below SQLite's limit on the number of query parameters
+            for chunk in chunked([int(uid) for uid in uids], 500):
+                rows.update(
+                    self.__db.execute(
+                        "SELECT uid, headers FROM headers WHERE host = ? "
+                        "AND user = ? AND folder = ? AND uidvalidity = ? "
+                        f"AND what = ? AND uid IN ({', '.join('?' * len(chunk))})",
+                        (*folder, what, *chunk),
+                    )
+                )
+
+        return {uid: rows[int(uid)] for uid in uids if int(uid) in rows}
+
+    def put(self, folder, what, headers) -> None:
+        """Cache the headers of messages in a folder
+
+        `headers` is a list of (uid, headers) tuples, see `get` for the rest.
+        """
+
+        with self.__lock, self.__db:
+            self.__db.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*folder, int(uid), what, body) for uid, body in headers],
+            )
+
+    def close(self):
+        """Close the database"""
+        self.__db.close()
+
+
+class MessageCache:
+    """An in-memory LRU cache of fetched messages, bounded by size
+
+    Bodies fetched with `IMAPMailbox.fetch`, and everything built on it like
+    `IMAPMessage.from_uid`, are kept by folder, UID and FETCH item. When the
+    cached bodies take more than `max_bytes` the least recently used ones are
+    evicted. `hits` and `misses` count the lookups.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """Create a new MessageCache object"""
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Get a cached body, or None when it is not cached"""
+
+        with self.__lock:
+            body = self.__entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return body
+
+    def put(self, key, body) -> None:
+        """Cache a body, evicting the least recently used ones when full"""
+
+        if len(body) > self.max_bytes:
+            return
+
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= len(self.__entries.pop(key))
+            self.__entries[key] = body
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                key, body = self.__entries.popitem(last=False)
+                self.size -= len(body)
+
+    def invalidate(self, folder, uids=None) -> None:
+        """Drop the cached bodies of some messages, or of a whole folder"""
+
+        with self.__lock:
+            for key in list(self.__entries):
+                if key[0] == folder and (uids is None or key[1] in uids):
+                    self.size -= len(self.__entries.pop(key))
+
+    def clear(self) -> None:
+        """Drop every cached body"""
+
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+
 class IMAPMailbox(mailbox.Mailbox):
     """A Mailbox class that uses an IMAPClient object as the backend"""
 
-    def __init__(self, host, user, password, folder="INBOX", port=993, security="SSL"):
-        """Create a new IMAPMailbox object"""
+    def __init__(
+        self,
+        host,
+        user,
+        password,
+        folder="INBOX",
+        port=993,
+        security="SSL",
+        batch_size=500,
+        use_uid=False,
+        header_fields=None,
+        lazy=False,
+        batch_bytes=32 * 1024 * 1024,
+        pool=None,
+        pipeline_depth=2,
+        compress=None,
+        retry=None,
+        readonly=False,
+        ssl_context=None,
+        keepalive=None,
+        header_cache=None,
+        message_cache=None,
+        prefetch_bytes=0,
+    ):
+        """Create a new IMAPMailbox object
+
+        `batch_size` is the number of messages fetched per FETCH command when
+        iterating over the mailbox, `items()` and `values()`. Set it to `None`
+        to fetch messages one by one.
+
+        With `use_uid=True` every command is sent as its UID variant, so message
+        keys are UIDs that do not shift when messages are expunged. They remain
+        valid for as long as the folder's `uidvalidity` does not change.
+
+        `header_fields` limits the headers fetched when iterating over the
+        mailbox to the given list, like ["From", "Subject", "Date"]. By default
+        all headers are fetched.
+
+        With `lazy=True`, `values()` and `items()` return `IMAPMessageProxy`
+        objects that only fetch headers and bodies when they are accessed.
+        Loading the body of a proxy also loads the bodies of the following
+        proxies of its batch, as long as they add up to at most
+        `prefetch_bytes`. By default only the requested body is fetched.
+
+        `batch_bytes` bounds the total size of the messages fetched by each
+        FETCH command of `items()`. Set it to `None` to only bound batches by
+        `batch_size`.
+
+        With an `IMAPConnectionPool` as `pool`, connections are checked out of
+        the pool and returned to it instead of being opened and logged out.
+
+        `pipeline_depth` is the number of batch FETCH commands sent together,
+        without waiting for the previous one to complete, when iterating over
+        the mailbox.
+
+        `compress` controls COMPRESS=DEFLATE (RFC 4978). By default compression
+        is used when the server advertises it, set it to True to always request
+        it or to False to never use it.
+
+        With a `RetryPolicy` as `retry` and `use_uid=True`, iterating over the
+        mailbox, `items()` and `fetch()` reconnect when the connection drops
+        and resume after the last delivered message instead of failing.
+
+        With `readonly=True` folders are opened with EXAMINE instead of SELECT,
+        for jobs that never modify the mailbox.
+
+        `ssl_context` is the `ssl.SSLContext` used for SSL and STARTTLS. By
+        default all mailboxes share one context. TLS sessions are resumed when
+        reconnecting to a server with the same context, `tls_metrics` counts
+        the handshakes, how many were resumed and the time they took.
+
+        With `keepalive` set to a number of seconds, a background thread sends
+        NOOP once the connection has been idle that long, and reconnects when
+        the server has dropped it. Use a value well below the server's idle
+        timeout, which is at least 30 minutes per RFC 9051.
+
+        With a `HeaderCache` as `header_cache`, iterating over the mailbox only
+        fetches the headers of messages that are not cached yet. Messages are
+        still yielded in the order of `keys()`. The cache is keyed by UID, so it
+        requires `use_uid=True`.
+
+        With a `MessageCache` as `message_cache`, messages fetched again, for
+        example with `IMAPMessage.from_uid`, are served from memory. Cached
+        messages are dropped when STORE, MOVE or EXPUNGE is sent through this
+        mailbox. Message numbers shift when other clients expunge messages, so
+        the cache requires `use_uid=True`.
+        """
+        if header_cache is not None and not use_uid:
+            raise ValueError("header_cache requires use_uid=True")
+        if message_cache is not None and not use_uid:
+            raise ValueError("message_cache requires use_uid=True")
+
         self.host = host
         self.user = user
         self.password = password
+        self.batch_size = batch_size
+        self.use_uid = use_uid
+        self.header_fields = header_fields
+        self.lazy = lazy
+        self.batch_bytes = batch_bytes
+        self.pool = pool
+        self.pipeline_depth = pipeline_depth
+        self.compress = compress
+        self.retry = retry
+        self.readonly = readonly
+        self.ssl_context = ssl_context or DEFAULT_SSL_CONTEXT
+        self.tls_metrics = {"handshakes": 0, "resumed": 0, "handshake_seconds": 0.0}
+        self.keepalive = keepalive
+        self.header_cache = header_cache
+        self.message_cache = message_cache
+        self.prefetch_bytes = prefetch_bytes
+        self.__lock = threading.RLock()
+        self.__keepalive_timer = None
+        self.__last_command = time.monotonic()
+        self.__streaming = False
+        self.__uidvalidity = None
+        self.__select_status = {}
+        self.__selected = None
         self.__folder = folder
         self.__security = security
         self.__port = port
 
     def connect(self):
         """Connect to the IMAP server"""
+
+        # select the folder again in the mode it was selected in before
+        readonly = self.__selected[1] if self.__selected else None
+        if self.pool is None:
+            self.__m = self.__open()
+            self.__selected = None
+        else:
+            self.__m, state = self.pool.acquire(
+                self.__account, self.__open, self.__folder
+            )
+            if "folder" in state:
+                self.__selected = (state["folder"], state["readonly"])
+                self.__uidvalidity = state["uidvalidity"]
+                self.__select_status = state["status"]
+            else:
+                self.__selected = None
+
+        try:
+            if self.keepalive:
+                self.__watch()
+                if self.__keepalive_timer is None:
+                    self.__keepalive_timer = RepeatingTimer(
+                        self.keepalive / 2, self.__keepalive
+                    )
+                    self.__keepalive_timer.start()
+
+            self.select(self.__folder, readonly)
+        except BaseException:
+            # disconnect() is not called when connecting fails, give back the
+            # pool slot here or it stays taken for good
+            if self.__keepalive_timer is not None:
+                self.__keepalive_timer.stop()
+                self.__keepalive_timer = None
+            if self.pool is not None:
+                self.pool.release(self.__account, self.__m, discard=True)
+            raise
+
+    def __watch(self):
+        """Record when commands are sent, and make them wait for keepalive NOOPs"""
+
+        command = self.__m._command
+
+        def watched_command(*args):
+            with self.__lock:
+                self.__last_command = time.monotonic()
+                return command(*args)
+
+        self.__m._command = watched_command
+
+    def __keepalive(self):
+        """Send NOOP when the connection is idle, reconnect when it was dropped"""
+
+        with self.__lock:
+            if self.__keepalive_timer is None:
+                # disconnected while waiting for the lock
+                return
+
+            idle = time.monotonic() - self.__last_command
+            if self.__m.tagged_commands or idle < self.keepalive:
+                return
+
+            try:
+                handle_response(self.__m.noop())
+            except (imaplib.IMAP4.abort, OSError) as error:
+                log.info(f"Keepalive failed: {error}")
+                self.reconnect()
+                return
+
+            # flag changes reported by NOOP must not mix with the next FETCH
+            self.__m.untagged_responses.pop("FETCH", None)
+
+    def __open(self):
+        """Open a new connection to the IMAP server and log in"""
+
+        context = TLSSessionContext(
+            self.ssl_context, (self.host, self.__port), self.tls_metrics
+        )
         if self.__security == "SSL":
             log.info("Connecting to IMAP server using SSL")
-            self.__m = imaplib.IMAP4_SSL(self.host, self.__port)
+            connection = imaplib.IMAP4_SSL(self.host, self.__port, ssl_context=context)
         elif self.__security == "STARTTLS":
             log.info("Connecting to IMAP server using STARTTLS")
-            self.__m = imaplib.IMAP4(self.host, self.__port)
-            self.__m.starttls()
+            connection = imaplib.IMAP4(self.host, self.__port)
+            connection.starttls(context)
         else:
             raise ValueError("Invalid security type")
-        self.__m.login(self.user, self.password)
-        self.select(self.__folder)
+        typ, data = connection.login(self.user, self.password)
+        context.remember(connection.sock)
+
+        # most servers announce their new capabilities in the LOGIN response,
+        # only ask for them when they do not
+        code = RESPONSE_CODE_RE.match(data[-1])
+        if code and code.group(1) == b"CAPABILITY":
+            capabilities = code.group(2)
+        else:
+            capabilities = handle_response(connection.capability())[-1]
+        connection.capabilities = tuple(capabilities.decode().upper().split())
+
+        if self.compress is None:
+            compress = "COMPRESS=DEFLATE" in connection.capabilities
+        else:
+            compress = self.compress
+
+        if "QRESYNC" in connection.capabilities:
+            # lets `sync` learn about expunged messages from UID FETCH
+            handle_response(connection.enable("QRESYNC"))
+
+        if compress:
+            log.info("Enabling COMPRESS=DEFLATE")
+            handle_response(connection._simple_command("COMPRESS", "DEFLATE"))
+            DeflateIO(connection)
+
+        return connection
+
+    @property
+    def __account(self):
+        """The key of this mailbox's connections in the pool"""
+        return (self.host, self.__port, self.user)
 
     def disconnect(self):
-        """Disconnect from the IMAP server"""
+        """Disconnect from the IMAP server
 
-        log.info("Disconnecting from IMAP server")
-        self.__m.close()
-        self.__m.logout()
+        Pooled connections are returned to the pool with the folder still
+        selected. Like CLOSE, messages marked for deletion are expunged.
+        """
+
+        if self.__keepalive_timer is not None:
+            self.__keepalive_timer.stop()
+            self.__keepalive_timer = None
+
+        with self.__lock:
+            # the connection outlives this mailbox when it is pooled
+            vars(self.__m).pop("_command", None)
+
+        self.__invalidate("EXPUNGE")
+        if self.pool is None:
+            log.info("Disconnecting from IMAP server")
+            self.__m.close()
+            self.__m.logout()
+            return
+
+        log.info("Returning connection to the pool")
+        try:
+            if self.__selected and not self.__selected[1]:
+                self.__m.expunge()
+        except (imaplib.IMAP4.abort, OSError):
+            self.pool.release(self.__account, self.__m, discard=True)
+            raise
+
+        state = None
+        if self.__selected is not None:
+            folder, readonly = self.__selected
+            state = {
+                "folder": folder,
+                "readonly": readonly,
+                "uidvalidity": self.__uidvalidity,
+                "status": self.__select_status,
+            }
+        self.pool.release(self.__account, self.__m, state)
 
     def __enter__(self):
         self.connect()
@@ -140,59 +1460,274 @@ class IMAPMailbox(mailbox.Mailbox):
         self.disconnect()
 
     def __iter__(self):
-        """Iterate over all messages in the mailbox"""
-        data = handle_response(self.__m.search(None, "ALL"))
-        for uid in data[0].decode().split():
-            yield IMAPMessageHeadersOnly.from_uid(uid, self)
+        """Iterate over all messages in the mailbox
+
+        Headers are fetched in batches of `batch_size` messages, one FETCH
+        command per batch, and `pipeline_depth` batches are requested at once.
+        Messages are yielded as soon as their batch is parsed.
+        """
+
+        uids = self.keys()
+        if self.header_cache is None or self.__uidvalidity is None:
+            headers = self.__resume(self.__headers, uids)
+        else:
+            headers = self.__cached_headers(uids)
+
+        for uid, body in headers:
+            yield IMAPMessageHeadersOnly(body)
+
+    def __headers(self, uids):
+        """Fetch the headers of messages, yield them with their UIDs"""
+
+        what = headers_fetch_item(self.header_fields)
+        if not self.batch_size:
+            for uid in uids:
+                yield from self.fetch(uid, what)
+            return
+
+        batches = list(chunked(uids, self.batch_size))
+        for group in chunked(batches, self.pipeline_depth or 1):
+            commands = [("FETCH", sequence_set(batch), what) for batch in group]
+            for response in self.pipeline(*commands):
+                for uid, items in self.__parse_fetch(handle_response(response)):
+                    body = fetch_body(items)
+                    if body is not None:
+                        yield str(uid), body
+
+    def __cached_headers(self, uids):
+        """Yield headers from the header cache, fetch and cache the missing ones
+
+        The cache is read one group of `pipeline_depth` batches at a time, the
+        missing headers of the group are fetched and merged in key order.
+        """
+
+        folder = (self.host, self.user, self.__folder, self.__uidvalidity)
+        what = headers_fetch_item(self.header_fields)
+        size = (self.batch_size or 1) * (self.pipeline_depth or 1)
+        for group in chunked(uids, size):
+            cached = self.header_cache.get(folder, what, group)
+            missing = [uid for uid in group if uid not in cached]
+            log.info(f"Found {len(cached)} cached headers, fetching {len(missing)}")
+
+            fetched = {}
+            try:
+                if missing:
+                    for uid, body in self.__resume(self.__headers, missing):
+                        fetched[uid] = body
+            finally:
+                self.header_cache.put(folder, what, fetched.items())
+
+            for uid in group:
+                body = cached[uid] if uid in cached else fetched.get(uid)
+                if body is not None:
+                    yield uid, body
 
     def values(self):
-        yield from iter(self)
+        if self.lazy:
+            yield from self.__proxies()
+        else:
+            yield from iter(self)
 
     def keys(self) -> list[str]:
         """Get a list of all message UIDs in the mailbox"""
-        data = handle_response(self.__m.search(None, "ALL"))
-        return data[0].decode().split()
+        return self.__search("ALL")
 
     def items(self):
-        """Iterate over all messages in the mailbox"""
-        uids = ",".join(self.keys()).encode()
-        return self.fetch(uids, "RFC822")
+        """Iterate over all messages in the mailbox
+
+        Messages are fetched in batches of at most `batch_size` messages and
+        `batch_bytes` bytes, planned from their RFC822.SIZE, so memory use does
+        not grow with the size of the folder. A message larger than
+        `batch_bytes` is fetched on its own. Each batch is read completely
+        before its messages are yielded, so other commands can be sent while
+        iterating.
+        """
+        if self.lazy:
+            for proxy in self.__proxies():
+                yield proxy.uid, proxy
+            return
+
+        yield from self.__resume(self.__items, self.keys())
+
+    def __items(self, uids, what="RFC822"):
+        """Fetch full messages in batches bounded by count and bytes"""
+
+        for batch in self.__sized_batches(uids):
+            yield from self.__fetch(sequence_set(batch), what)
+
+    def __sized_batches(self, uids):
+        """Split UIDs into batches bounded by `batch_size` and `batch_bytes`"""
+
+        for chunk in chunked(uids, self.batch_size or 1):
+            if not self.batch_bytes:
+                yield chunk
+                continue
+
+            sizes = {
+                str(uid): items.get("RFC822.SIZE", 0)
+                for uid, items in self.fetch_items(
+                    sequence_set(chunk), "(UID RFC822.SIZE)"
+                )
+            }
+
+            batch, batch_total = [], 0
+            for uid in chunk:
+                size = sizes.get(uid, 0)
+                if batch and batch_total + size > self.batch_bytes:
+                    yield batch
+                    batch, batch_total = [], 0
+
+                batch.append(uid)
+                batch_total += size
+
+            if batch:
+                yield batch
+
+    def __proxies(self):
+        """Iterate over lazy proxies of all messages, listed in batches"""
+
+        what = "(UID RFC822.SIZE FLAGS INTERNALDATE)"
+        for batch in chunked(self.keys(), self.batch_size or 1):
+            proxies = []
+            for uid, items in self.fetch_items(sequence_set(batch), what):
+                proxy = IMAPMessageProxy(
+                    str(uid),
+                    self,
+                    proxies,
+                    size=items.get("RFC822.SIZE"),
+                    flags=items.get("FLAGS"),
+                    internaldate=items.get("INTERNALDATE"),
+                )
+                proxies.append(proxy)
+
+            yield from proxies
 
     @property
     def capability(self):
         """Get the server capabilities"""
-        return handle_response(self.__m.capability())[0].decode()
+        return " ".join(self.__m.capabilities)
+
+    @property
+    def capabilities(self) -> frozenset:
+        """Get the server capabilities as a set
+
+        The capabilities are read once per connection, after logging in. They
+        choose the fastest mechanism the server supports, for example MOVE,
+        UIDPLUS, ESEARCH, LITERAL+, COMPRESS=DEFLATE and BINARY.
+        """
+        return frozenset(self.__m.capabilities)
 
     def add(self, message):
-        """Add a message to the mailbox"""
+        """Add a message to the mailbox
 
-        self.__m.append(
-            self.current_folder,
-            "",
-            imaplib.Time2Internaldate(time.time()),
-            message.as_bytes(),
+        With LITERAL+ the message is sent without waiting for the server to
+        accept the literal, saving a round trip.
+        """
+
+        date = imaplib.Time2Internaldate(time.time())
+        if "LITERAL+" not in self.capabilities:
+            handle_response(
+                self.__m.append(self.current_folder, "", date, message.as_bytes())
+            )
+            return
+
+        data = imaplib.MapCRLF.sub(imaplib.CRLF, message.as_bytes())
+        literal = b"{%d+}\r\n" % len(data) + data
+        handle_response(
+            self.__m._simple_command("APPEND", self.current_folder, date, literal)
         )
 
     def copy(self, messageset: bytes, folder: str) -> None:
         """Copy a message to a different folder"""
 
-        self.__m.copy(messageset, folder)
+        self.__command("COPY", messageset, folder)
 
     def move(self, messageset: bytes, folder: str) -> None:
-        """Move a message to a different folder"""
+        """Move a message to a different folder
 
-        self.__m._simple_command("MOVE", messageset, folder)
+        Servers without MOVE get a COPY followed by `remove`.
+        """
+
+        if "MOVE" in self.capabilities:
+            handle_response(self.__command("MOVE", messageset, folder))
+        else:
+            handle_response(self.__command("COPY", messageset, folder))
+            self.remove(messageset)
 
     def discard(self, messageset: bytes) -> None:
         """Mark messages for deletion"""
 
-        self.__m.store(messageset, "+FLAGS", "\\Deleted")
+        self.__command("STORE", messageset, "+FLAGS", "\\Deleted")
 
     def remove(self, messageset: bytes) -> None:
-        """Remove messages from the mailbox"""
+        """Remove messages from the mailbox
+
+        In UID mode, when the server supports UIDPLUS, only the given messages
+        are expunged. Otherwise every message marked for deletion is expunged.
+        """
+
+        store = ("STORE", messageset, "+FLAGS", "\\Deleted")
+        if self.use_uid and "UIDPLUS" in self.capabilities:
+            expunge = ("EXPUNGE", messageset)
+        else:
+            expunge = ("EXPUNGE",)
+
+        for response in self.pipeline(store, expunge):
+            handle_response(response)
+
+    def pipeline(self, *commands) -> list:
+        """Send several commands at once and wait for all of them to complete
+
+        Each command is a tuple of command name and arguments, for example
+        ("STORE", b"1:10", "+FLAGS", "\\Seen"). All commands are written before
+        any response is read, so a batch of independent commands costs a single
+        round trip. In UID mode the commands are sent as their UID variants.
 
-        self.discard(messageset)
-        self.__m.expunge()
+        Untagged FETCH and SEARCH responses are attributed to the oldest
+        command that has not completed yet. When a command fails with BAD, the
+        error is raised once the responses of every command have been read.
+
+        Returns:
+            list: A (status, data) tuple per command, with the untagged data of
+            FETCH, STORE and SEARCH commands, or the completion text otherwise
+        """
+
+        self.__check_idle()
+        tags = []
+        for name, *args in commands:
+            self.__invalidate(name, *args[:1])
+            if self.use_uid and (name in UID_COMMANDS or name == "EXPUNGE" and args):
+                tags.append((name, self.__m._command("UID", name, *args)))
+            else:
+                tags.append((name, self.__m._command(name, *args)))
+
+        responses = []
+        error = None
+        for name, tag in tags:
+            untagged_name = "FETCH" if name == "STORE" else name
+            data = []
+            while self.__m.tagged_commands[tag] is None:
+                self.__m._get_response()
+                data.extend(self.__m.untagged_responses.pop(untagged_name, []))
+
+            try:
+                status, text = self.__m._command_complete(name, tag)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as command_error:
+                # read the responses of the later commands before raising, or
+                # they would be taken for the responses of the next command
+                error = error or command_error
+                continue
+
+            if name in ("FETCH", "STORE", "SEARCH"):
+                responses.append((status, data))
+            else:
+                responses.append((status, text))
+
+        if error is not None:
+            raise error
+        return responses
 
     def __delitem__(self, key: str) -> None:
         raise NotImplementedError("Use discard() instead")
@@ -200,87 +1735,329 @@ class IMAPMailbox(mailbox.Mailbox):
     def __len__(self) -> int:
         return len(self.keys())
 
-    def fetch(self, messageset: bytes, what):
-        """Fetch messages from the mailbox"""
+    def fetch(self, messageset: bytes, what, stream=False):
+        """Fetch messages from the mailbox
 
-        messages = handle_response(self.__m.fetch(messageset, what))[::2]
+        Yields a tuple of UID and body for each message, where the body is the
+        RFC822, BODY[...] or BINARY[...] item requested in `what`.
+        Use `fetch_items` to get every data item of the response.
 
-        for head, body in messages:
-            uid, what, size = MESSAGE_HEAD_RE.match(head.decode()).groups()
-            if size != str(len(body)):
-                raise Exception("Size mismatch")
+        By default imaplib reads the whole response before the first message is
+        yielded. With `stream=True` the response is read from the socket one
+        message at a time, so only the message being yielded is kept in memory.
+        The connection is busy until the generator is exhausted or closed,
+        sending another command through the mailbox meanwhile raises an error.
+
+        With a `message_cache`, fetching a single message is served from the
+        cache when possible. Streamed messages and partial fetches like
+        BODY.PEEK[]<0.1024> are not cached.
+        """
 
+        messages = self.__resume(
+            lambda messageset: self.__fetch(messageset, what, stream), messageset
+        )
+        if self.message_cache is None or stream or PARTIAL_RE.search(what):
+            yield from messages
+            return
+
+        key = messageset.decode() if isinstance(messageset, bytes) else str(messageset)
+        if key.isdigit():
+            body = self.message_cache.get((self.__cache_folder, key, what))
+            if body is not None:
+                yield key, body
+                return
+
+        for uid, body in messages:
+            self.message_cache.put((self.__cache_folder, uid, what), body)
             yield uid, body
 
-    def __expand_search_macros(self, query) -> str:
-        """Expand search macros in the query."""
+    @property
+    def __cache_folder(self):
+        """The key of the current folder in the message cache"""
+        return (*self.__account, self.__folder, self.__uidvalidity)
 
-        today = datetime.date.today()
-        yesterday = today - datetime.timedelta(days=1)
+    def __invalidate(self, command, messageset=None):
+        """Drop cached messages that a command changes or removes"""
 
-        week_start = today - datetime.timedelta(days=today.weekday())
-        last_week_start = week_start - datetime.timedelta(days=7)
+        command = command.upper()
+        if self.message_cache is None or command not in ("STORE", "MOVE", "EXPUNGE"):
+            return
 
-        month_start = datetime.date(today.year, today.month, 1)
-        year_start = datetime.date(today.year, 1, 1)
+        if isinstance(messageset, bytes):
+            messageset = messageset.decode()
 
-        if today.month == 1:  # January
-            # last month is December of the previous year
-            last_month_start = datetime.date(today.year - 1, 12, 1)
+        if messageset is None or "*" in str(messageset):
+            self.message_cache.invalidate(self.__cache_folder)
         else:
-            last_month_start = datetime.date(today.year, today.month - 1, 1)
+            uids = set(parse_sequence_set(str(messageset)))
+            self.message_cache.invalidate(self.__cache_folder, uids)
 
-        last_year_start = datetime.date(today.year - 1, 1, 1)
+    def __fetch(self, messageset: bytes, what, stream=False):
+        """Fetch messages from the mailbox, without reconnecting"""
 
-        q = query
-        q = q.replace("FIND", "TEXT")
+        for uid, items in self.fetch_items(messageset, what, stream):
+            body = fetch_body(items)
+            if body is None:
+                # unsolicited FETCH response, e.g. a flag update
+                continue
 
-        q = q.replace("TODAY", f"ON {imap_date(today)}")
-        q = q.replace("YESTERDAY", f"ON {imap_date(yesterday)}")
+            yield str(uid), body
 
-        q = q.replace("THISWEEK", f"SINCE {imap_date(week_start)}")
-        q = q.replace("THISMONTH", f"SINCE {imap_date(month_start)}")
-        q = q.replace("THISYEAR", f"SINCE {imap_date(year_start)}")
+    def stream(self, uid, section="", chunk_size=1024 * 1024, binary=False):
+        """Stream a message, or a section of it, in chunks
 
-        q = q.replace("LASTWEEK", imap_date_range(last_week_start, week_start))
-        q = q.replace("LASTMONTH", imap_date_range(last_month_start, month_start))
-        q = q.replace("LASTYEAR", imap_date_range(last_year_start, year_start))
+        The message is fetched with BODY.PEEK[section]<offset.length> partial
+        fetches of `chunk_size` bytes, so it can be written to disk or hashed
+        without holding more than one chunk in memory. The default empty
+        section streams the whole message, use "TEXT" or a part number like
+        "2.1" to stream a single section. Fetching does not set the \\Seen flag.
 
-        # shortcuts
-        q = q.replace("PASTDAY", "PAST1DAY")
-        q = q.replace("PASTWEEK", "PAST1WEEK")
-        q = q.replace("PASTMONTH", "PAST1MONTH")
-        q = q.replace("PASTYEAR", "PAST1YEAR")
+        With `binary=True` a part is fetched with BINARY.PEEK (RFC 3516), so the
+        server removes its content transfer encoding.
+        """
 
-        # use regex to match the PASTXDAYS macro
-        q = re.sub(
-            r"PAST(\d+)DAYS?",
-            lambda m: f"SINCE {imap_date(change_time(today, days=-int(m.group(1))))}",
-            q,
-        )
+        item = "BINARY.PEEK" if binary else "BODY.PEEK"
+        offset = 0
+        while True:
+            what = f"{item}[{section}]<{offset}.{chunk_size}>"
+            chunk = b"".join(body for uid, body in self.fetch(uid, what))
+            if chunk:
+                yield chunk
 
-        # use regex to match the PASTXWEEKS macro
-        q = re.sub(
-            r"PAST(\d+)WEEKS?",
-            lambda m: f"SINCE {imap_date(change_time(today, weeks=-int(m.group(1))))}",
-            q,
-        )
+            if len(chunk) < chunk_size:
+                return
 
-        # use regex to match the PASTXMONTHS macro
-        q = re.sub(
-            r"PAST(\d+)MONTHS?",
-            lambda m: f"SINCE {imap_date(change_time(today, days=-int(m.group(1)) * 30))}",
-            q,
-        )
+            offset += len(chunk)
+
+    def attachments(self, uid) -> list:
+        """Get the attachment parts of a message
+
+        The parts are found through the message BODYSTRUCTURE, their payloads
+        are not downloaded. Pass them to `save_attachment` to save them.
+
+        Returns:
+            list: IMAPMessageLazy parts with a filename or an attachment disposition
+        """
+
+        message = IMAPMessageLazy.from_uid(uid, self)
+        return [
+            part
+            for part in message.walk()
+            if part.section is not None
+            and (part.get_content_disposition() == "attachment" or part.get_filename())
+        ]
+
+    def save_attachment(self, uid, part, target, chunk_size=1024 * 1024) -> int:
+        """Save the decoded payload of a message part to a file
+
+        `target` is a path or a writable binary file object. The part is
+        streamed with partial fetches and decoded chunk by chunk, so memory use
+        is bounded by `chunk_size` no matter how large the attachment is.
+
+        Returns:
+            int: The number of decoded bytes written
+        """
 
-        # use regex to match the PASTXYEARS macro
-        q = re.sub(
-            r"PAST(\d+)YEARS?",
-            lambda m: f"SINCE {imap_date(change_time(today, days=-int(m.group(1)) * 365))}",
-            q,
+        if isinstance(target, (str, os.PathLike)):
+            with open(target, "wb") as file:
+                return self.save_attachment(uid, part, file, chunk_size)
+
+        encoding = part.get("Content-Transfer-Encoding")
+        binary = (
+            "BINARY" in self.capabilities
+            and part.section[0].isdigit()
+            and str(encoding).strip().lower() in ("base64", "quoted-printable")
         )
+        if binary:
+            # the server decodes the part, skip decoding it here
+            encoding = None
+        chunks = self.stream(uid, part.section, chunk_size, binary)
+
+        written = 0
+        for data in decode_transfer_encoding(chunks, encoding):
+            target.write(data)
+            written += len(data)
+
+        return written
+
+    def save_attachments(self, uid, directory, chunk_size=1024 * 1024) -> list:
+        """Save all attachments of a message to a directory
+
+        Returns:
+            list: The paths of the saved files
+        """
 
-        return q
+        paths = []
+        for part in self.attachments(uid):
+            filename = os.path.basename(part.get_filename() or "")
+            if not filename or filename in map(os.path.basename, paths):
+                filename = f"{part.section}-{filename or 'attachment'}"
+
+            path = os.path.join(directory, filename)
+            self.save_attachment(uid, part, path, chunk_size)
+            paths.append(path)
+
+        return paths
+
+    def fetch_items(self, messageset: bytes, what, stream=False):
+        """Fetch any mix of data items for messages in the mailbox
+
+        `what` can request several data items at once, for example
+        "(UID FLAGS INTERNALDATE RFC822.SIZE BODY.PEEK[HEADER])".
+
+        Yields a tuple of UID and a dict of data items for each message,
+        see `parse_fetch_response` for the format of the values.
+        """
+
+        if stream:
+            data = self.__fetch_stream(messageset, what)
+        else:
+            data = handle_response(self.__command("FETCH", messageset, what))
+
+        yield from self.__parse_fetch(data)
+
+    def __parse_fetch(self, data):
+        """Parse FETCH response data, keyed by UID in UID mode"""
+
+        for number, items in parse_fetch_response(data):
+            if self.use_uid:
+                if "UID" not in items:
+                    # unsolicited FETCH response, it only has a sequence number
+                    continue
+                number = items["UID"]
+
+            yield number, items
+
+    def reconnect(self):
+        """Drop the current connection, connect again and select the folder"""
+
+        log.info("Reconnecting to IMAP server")
+        if self.pool is not None:
+            self.pool.release(self.__account, self.__m, discard=True)
+        else:
+            try:
+                self.__m.shutdown()
+            except OSError:
+                pass
+
+        self.connect()
+
+    def __resume(self, operation, uids):
+        """Yield the (uid, value) tuples of operation(uids), surviving reconnects
+
+        `uids` is a list of UIDs or a message set. When the connection drops
+        and the mailbox has a `retry` policy, the mailbox reconnects and runs
+        the operation again for the messages that were not delivered yet.
+
+        Only UIDs survive a reconnect: sequence numbers shift when messages
+        are expunged meanwhile, so without `use_uid` the error is raised.
+        """
+
+        resumable = self.retry and self.use_uid
+        delays = self.retry.delays() if resumable else iter(())
+        delivered = set()
+        while True:
+            progress = False
+            try:
+                for uid, value in operation(uids):
+                    delivered.add(uid)
+                    progress = True
+                    yield uid, value
+                return
+            except (imaplib.IMAP4.abort, OSError) as error:
+                if progress and resumable:
+                    delays = self.retry.delays()
+                self.__recover(error, delays)
+
+            if isinstance(uids, list):
+                uids = [uid for uid in uids if uid not in delivered]
+                left = len(uids)
+            else:
+                keys = self.__search_keys(uids)
+                left = len([uid for uid in keys if uid not in delivered])
+                uids = sequence_set(uid for uid in keys if uid not in delivered)
+
+            log.info(f"Resuming with {left} messages left")
+            if not left:
+                return
+
+    def __recover(self, error, delays):
+        """Reconnect after a connection error, waiting between attempts
+
+        Raises the original error when the retry policy gives up.
+        """
+
+        for delay in delays:
+            log.warning(f"Connection lost: {error}, reconnecting in {delay}s")
+            time.sleep(delay)
+            try:
+                self.reconnect()
+                return
+            except (imaplib.IMAP4.abort, OSError) as reconnect_error:
+                error = reconnect_error
+
+        raise error
+
+    def __search_keys(self, messageset):
+        """Get the keys of the messages in a message set"""
+
+        criteria = ("UID", messageset) if self.use_uid else (messageset,)
+        return self.__search(*criteria)
+
+    def __search(self, *criteria) -> list[str]:
+        """Search for messages, or their UIDs in UID mode
+
+        With ESEARCH the results are returned as a compact sequence set.
+        """
+
+        if "ESEARCH" not in self.capabilities:
+            data = handle_response(self.__command("SEARCH", None, *criteria))
+            return data[0].decode().split()
+
+        handle_response(self.__command("SEARCH", None, "RETURN", "(ALL)", *criteria))
+        typ, data = self.__m.response("ESEARCH")
+        match = re.search(rb" ALL (\S+)", data[-1] or b"")
+        return parse_sequence_set(match.group(1)) if match else []
+
+    def __command(self, command, *args):
+        """Send a command, using its UID variant when in UID mode"""
+
+        self.__check_idle()
+        self.__invalidate(command, *args[:1])
+        if self.use_uid:
+            return self.__m.uid(command, *args)
+        if command == "MOVE":
+            return self.__m._simple_command(command, *args)
+        return getattr(self.__m, command.lower())(*args)
+
+    def __check_idle(self):
+        """Refuse to send a command while a streamed FETCH is being read
+
+        The command would read, and lose, the rest of the FETCH response.
+        """
+        if self.__streaming:
+            raise Exception("Cannot send a command while a streamed FETCH is open")
+
+    def __fetch_stream(self, messageset: bytes, what):
+        """Send a FETCH command and yield each message as soon as it is read"""
+
+        command = ("UID", "FETCH") if self.use_uid else ("FETCH",)
+        tag = self.__m._command(*command, messageset, what)
+        self.__streaming = True
+        try:
+            while self.__m.tagged_commands[tag] is None:
+                self.__m._get_response()
+                yield from self.__m.untagged_responses.pop("FETCH", [])
+        except GeneratorExit:
+            # the consumer stopped early, discard the rest of the response
+            while self.__m.tagged_commands[tag] is None:
+                self.__m._get_response()
+                self.__m.untagged_responses.pop("FETCH", None)
+            raise
+        finally:
+            self.__streaming = False
+
+        handle_response(self.__m._command_complete("FETCH", tag))
 
     def search(self, query):
         """Search for messages matching the query
@@ -344,16 +2121,222 @@ class IMAPMailbox(mailbox.Mailbox):
             bytes: A comma-separated list of message UIDs
         """
 
-        expanded_query = self.__expand_search_macros(query)
-        data = handle_response(self.__m.search(None, expanded_query))
-        num_results = len(data[0].split(b" "))
+        expanded_query = expand_search_macros(query)
+        uids = self.__search(expanded_query)
 
         log.info(f"Searching for messages matching: {query}")
         if expanded_query != query:
             log.info(f"Expanded search query to: {expanded_query}")
-        log.info(f"Found {num_results} results")
+        log.info(f"Found {len(uids)} results")
+
+        return ",".join(uids).encode()
+
+    def sync(self, state=None) -> dict:
+        """Get the changes to the current folder since a previous sync
+
+        `state` is the "state" of the previous result, None for the first sync.
+
+        Returns:
+            dict: With the following keys
+            - "new": the flags of new messages, by UID
+            - "changed": the flags of messages whose flags changed, by UID
+            - "vanished": the UIDs of expunged messages
+            - "reset": True on the first sync and when the UIDVALIDITY changed,
+              everything known about the folder must be discarded
+            - "state": the state to pass to the next sync, it can be stored as JSON
+
+        The folder is selected again to read its current UIDVALIDITY, UIDNEXT
+        and HIGHESTMODSEQ. With CONDSTORE only the messages changed since the
+        last sync are fetched, with UID FETCH CHANGEDSINCE. With QRESYNC the
+        server reports expunged messages too, otherwise they are found by
+        comparing UID lists. Nothing more is sent when the folder did not
+        change. Without CONDSTORE the flags of every message are fetched and
+        compared.
+        """
 
-        return data[0].replace(b" ", b",")
+        # STATUS must not be used to poll the selected folder (RFC 3501 6.3.10),
+        # selecting it again reports the same values
+        readonly = self.__selected[1] if self.__selected else None
+        self.__selected = None
+        self.select(self.__folder, readonly)
+        status = self.__select_status
+
+        condstore = (
+            "CONDSTORE" in self.capabilities and status["HIGHESTMODSEQ"] is not None
+        )
+        qresync = condstore and "QRESYNC" in self.capabilities
+
+        reset = state is None or state["uidvalidity"] != status["UIDVALIDITY"]
+        known = set() if reset else set(map(int, parse_sequence_set(state["uids"])))
+        incremental = not reset and condstore and "highestmodseq" in state
+        vanished = set()
+
+        if not status["MESSAGES"]:
+            flags = {}
+            vanished = known
+        elif not incremental:
+            flags = self.__sync_flags()
+            vanished = known - flags.keys()
+        elif state["highestmodseq"] == status["HIGHESTMODSEQ"] and (
+            # only QRESYNC requires expunges to raise HIGHESTMODSEQ
+            qresync
+            or status["UIDNEXT"] == state["uidnext"]
+            and status["MESSAGES"] == len(known)
+        ):
+            flags = {}
+        elif qresync:
+            modifier = f"(CHANGEDSINCE {state['highestmodseq']} VANISHED)"
+            flags = self.__sync_flags(modifier)
+            typ, data = self.__m.response("VANISHED")
+            for line in filter(None, data):
+                uids = parse_sequence_set(line.split()[-1])
+                vanished.update(known.intersection(map(int, uids)))
+        else:
+            flags = self.__sync_flags(f"(CHANGEDSINCE {state['highestmodseq']})")
+            data = handle_response(self.__m.uid("SEARCH", "ALL"))
+            vanished = known.difference(map(int, data[0].split()))
+
+        uids = (known - vanished) | flags.keys()
+        new_state = {
+            "uidvalidity": status["UIDVALIDITY"],
+            "uidnext": status["UIDNEXT"],
+            "uids": sequence_set(sorted(uids)).decode(),
+        }
+        if condstore:
+            new_state["highestmodseq"] = status["HIGHESTMODSEQ"]
+            changed = {uid: flags[uid] for uid in flags.keys() & known}
+        else:
+            # without mod-sequences the flags have to be compared
+            new_state["flags"] = {str(uid): flags[uid] for uid in sorted(uids)}
+            old_flags = {} if reset else state["flags"]
+            changed = {
+                uid: flags[uid]
+                for uid in flags.keys() & known
+                if flags[uid] != old_flags.get(str(uid))
+            }
+
+        log.info(
+            f"Synced {self.__folder}: {len(flags.keys() - known)} new, "
+            f"{len(changed)} changed, {len(vanished)} vanished"
+        )
+        return {
+            "new": {str(uid): flags[uid] for uid in sorted(flags.keys() - known)},
+            "changed": {str(uid): changed[uid] for uid in sorted(changed)},
+            "vanished": [str(uid) for uid in sorted(vanished)],
+            "reset": reset,
+            "state": new_state,
+        }
+
+    def __sync_flags(self, *modifiers) -> dict:
+        """Fetch the sorted flags of every message, or of changed ones, by UID"""
+
+        data = handle_response(self.__m.uid("FETCH", "1:*", "(UID FLAGS)", *modifiers))
+        return {
+            items["UID"]: sorted(items["FLAGS"])
+            for number, items in parse_fetch_response(data)
+            if "UID" in items and "FLAGS" in items
+        }
+
+    def mirror(self, path, folders=None) -> dict:
+        """Mirror folders into a local Maildir
+
+        `folders` defaults to the current folder. INBOX is mirrored into the
+        Maildir itself and other folders into Maildir++ sub-folders, for
+        example "Work/Projects" into ".Work.Projects".
+
+        The first run copies every message. Later runs only download new
+        messages, apply flag changes and remove expunged messages, see `sync`.
+        The sync state and the UID of every local message are kept in the
+        ".imap_mailbox.json" file of the Maildir.
+
+        IMAP flags are mapped to Maildir flags, \\Seen to S, \\Answered to R,
+        \\Flagged to F, \\Deleted to T and \\Draft to D.
+
+        Returns:
+            dict: The number of new, changed and vanished messages by folder
+        """
+
+        if not self.use_uid:
+            raise ValueError("mirror requires use_uid=True")
+
+        root = mailbox.Maildir(path)
+        state_path = os.path.join(path, ".imap_mailbox.json")
+        states = {}
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                states = json.load(file)
+
+        delimiters = {
+            folder: delimiter for _, delimiter, folder, _ in self.list_folders()
+        }
+        current = self.__folder
+        readonly = self.__selected[1] if self.__selected else None
+        summary = {}
+        for folder in folders or [current]:
+            if folder.upper() == "INBOX":
+                box = root
+            else:
+                box = root.add_folder(folder.replace(delimiters.get(folder, "/"), "."))
+
+            self.select(folder)
+            state = states.setdefault(folder, {"sync": None, "keys": {}})
+            summary[folder] = self.__mirror_folder(box, state, states, state_path)
+
+        self.select(current, readonly)
+        return summary
+
+    def __mirror_folder(self, box, state, states, state_path):
+        """Apply the changes of the current folder to a Maildir"""
+
+        changes = self.sync(state["sync"])
+        keys = state["keys"]
+
+        # an interrupted first run leaves messages to keep, only a changed
+        # UIDVALIDITY makes them invalid
+        if changes["reset"] and state["sync"] is not None:
+            for key in keys.values():
+                box.discard(key)
+            keys.clear()
+
+        for uid in changes["vanished"]:
+            if uid in keys:
+                box.discard(keys.pop(uid))
+
+        for uid, flags in changes["changed"].items():
+            if uid in keys:
+                message = box.get_message(keys[uid])
+                message.set_flags(maildir_flags(flags))
+                box[keys[uid]] = message
+
+        new = [uid for uid in changes["new"] if uid not in keys]
+        log.info(f"Mirroring {len(new)} new messages from {self.__folder}")
+        # BODY.PEEK does not set \Seen, unlike RFC822
+        messages = self.__resume(lambda uids: self.__items(uids, "BODY.PEEK[]"), new)
+        for count, (uid, body) in enumerate(messages, 1):
+            message = mailbox.MaildirMessage(body)
+            message.set_subdir("cur")
+            message.set_flags(maildir_flags(changes["new"][uid]))
+            keys[uid] = box.add(message)
+
+            # save progress, so an interrupted run does not download again
+            if count % (self.batch_size or 1) == 0:
+                self.__save_mirror(state_path, states)
+
+        state["sync"] = changes["state"]
+        self.__save_mirror(state_path, states)
+
+        return {
+            "new": len(new),
+            "changed": len(changes["changed"]),
+            "vanished": len(changes["vanished"]),
+        }
+
+    def __save_mirror(self, state_path, states):
+        """Write the mirror state, replacing the previous file atomically"""
+
+        with open(state_path + ".tmp", "w") as file:
+            json.dump(states, file)
+        os.replace(state_path + ".tmp", state_path)
 
     def list_folders(self) -> tuple:
         """List all folders in the mailbox
@@ -368,13 +2351,520 @@ class IMAPMailbox(mailbox.Mailbox):
             display_name = folder.split(delimiter)[-1]
             yield (flags, delimiter, folder, display_name)
 
+    def map_folders(self, folders, func, max_workers=4):
+        """Run an operation on several folders at the same time
+
+        `func` is called with an IMAPMailbox that has the folder selected, for
+        example `len` or `lambda mailbox: mailbox.search("UNSEEN")`. The folders
+        are processed by `max_workers` threads, each with its own connection
+        taken from this mailbox's pool, or from a temporary pool when the
+        mailbox has none.
+
+        Yields a tuple of folder and result as each folder finishes. An
+        exception raised by `func` is raised again when its result is reached.
+        """
+
+        pool = self.pool or IMAPConnectionPool(max_workers, max_workers)
+
+        def run(folder):
+            with self.__clone(folder, pool) as mailbox:
+                return func(mailbox)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        futures = {executor.submit(run, folder): folder for folder in folders}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+            if pool is not self.pool:
+                pool.close()
+
+    def __clone(self, folder, pool):
+        """Create a disconnected copy of this mailbox for another folder"""
+
+        clone = copy.copy(self)
+        clone.__folder = folder
+        clone.__uidvalidity = None
+        clone.__select_status = {}
+        clone.__selected = None
+        clone.__lock = threading.RLock()
+        clone.__keepalive_timer = None
+        clone.__streaming = False
+        clone.pool = pool
+        return clone
+
+    @property
+    def current_folder(self):
+        """Get the currently selected folder"""
+        return self.__folder
+
+    @property
+    def uidvalidity(self):
+        """Get the UIDVALIDITY of the currently selected folder
+
+        UIDs from `use_uid` mode are only valid while this value is unchanged.
+        """
+        return self.__uidvalidity
+
+    @property
+    def highestmodseq(self):
+        """Get the HIGHESTMODSEQ of the currently selected folder
+
+        The value is the one reported when the folder was last selected, it
+        changes whenever a message in the folder changes. `sync` selects the
+        folder again to compare it. Only servers with CONDSTORE report it, for
+        other servers it is None.
+        """
+        return self.__select_status.get("HIGHESTMODSEQ")
+
+    def select(self, folder, readonly=None):
+        """Select a folder
+
+        With `readonly=True` the folder is opened with EXAMINE, so the server
+        does not have to track read-write state. When `readonly` is not given
+        the mailbox `readonly` setting is used. It only applies to this
+        selection.
+
+        Nothing is sent when the folder is already selected in the same mode.
+        """
+        if readonly is None:
+            readonly = self.readonly
+
+        self.__folder = folder
+        if self.__selected == (folder, readonly):
+            log.debug(f"Folder {folder} is already selected")
+            return self
+
+        self.__check_idle()
+        self.__selected = None
+        data = handle_response(self.__m.select(folder, readonly))
+        self.__selected = (folder, readonly)
+
+        self.__select_status = {"MESSAGES": int(data[-1] or 0)}
+        for name in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"):
+            typ, data = self.__m.response(name)
+            self.__select_status[name] = int(data[-1]) if data[-1] else None
+        self.__uidvalidity = self.__select_status["UIDVALIDITY"]
+        return self
+
+
+class AsyncIMAPMailbox:
+    """An asyncio version of IMAPMailbox built on asyncio streams
+
+    It has the same surface as `IMAPMailbox`, with coroutines instead of
+    blocking calls, so a single event loop can drive many IMAP sessions.
+    `fetch()`, `fetch_items()` and `list_folders()` are async generators and
+    the mailbox supports `async for` to iterate over headers only messages.
+
+    Commands on one mailbox run one at a time, use several mailboxes to run
+    commands concurrently. STARTTLS requires Python 3.11 or later.
+    """
+
+    def __init__(
+        self,
+        host,
+        user,
+        password,
+        folder="INBOX",
+        port=993,
+        security="SSL",
+        batch_size=500,
+        use_uid=False,
+        header_fields=None,
+        readonly=False,
+    ):
+        """Create a new AsyncIMAPMailbox object, see `IMAPMailbox` for the options"""
+        self.host = host
+        self.user = user
+        self.password = password
+        self.batch_size = batch_size
+        self.use_uid = use_uid
+        self.header_fields = header_fields
+        self.readonly = readonly
+        self.__folder = folder
+        self.__security = security
+        self.__port = port
+        self.__uidvalidity = None
+        self.__selected = None
+        self.__capabilities = ()
+        self.__tag = 0
+        self.__lock = asyncio.Lock()
+
+    async def connect(self):
+        """Connect to the IMAP server"""
+
+        if self.__security == "SSL":
+            log.info("Connecting to IMAP server using SSL")
+            self.__reader, self.__writer = await asyncio.open_connection(
+                self.host, self.__port, ssl=ssl.create_default_context(), limit=2**24
+            )
+            await self.__read_response()
+        elif self.__security == "STARTTLS":
+            log.info("Connecting to IMAP server using STARTTLS")
+            self.__reader, self.__writer = await asyncio.open_connection(
+                self.host, self.__port, limit=2**24
+            )
+            await self.__read_response()
+            await self.__simple_command("STARTTLS")
+            await self.__writer.start_tls(
+                ssl.create_default_context(), server_hostname=self.host
+            )
+        else:
+            raise ValueError("Invalid security type")
+
+        data = await self.__simple_command(
+            "LOGIN", imap_quote(self.user), imap_quote(self.password)
+        )
+        if not data["CAPABILITY"]:
+            data = await self.__simple_command("CAPABILITY")
+        self.__capabilities = tuple(data["CAPABILITY"][-1].decode().upper().split())
+        readonly = self.__selected[1] if self.__selected else None
+        self.__selected = None
+        await self.select(self.__folder, readonly)
+
+    async def disconnect(self):
+        """Disconnect from the IMAP server"""
+
+        log.info("Disconnecting from IMAP server")
+        await self.__simple_command("CLOSE")
+        await self.__simple_command("LOGOUT")
+        self.__writer.close()
+        await self.__writer.wait_closed()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.disconnect()
+
+    async def __aiter__(self):
+        """Iterate over all messages in the mailbox
+
+        Headers are fetched in batches of `batch_size` messages, one FETCH
+        command per batch.
+        """
+
+        what = headers_fetch_item(self.header_fields)
+        for batch in chunked(await self.keys(), self.batch_size or 1):
+            async for uid, body in self.fetch(sequence_set(batch), what):
+                yield IMAPMessageHeadersOnly(body)
+
+    async def keys(self) -> list[str]:
+        """Get a list of all message UIDs in the mailbox"""
+        data = await self.__command("SEARCH", "ALL")
+        return b" ".join(data).decode().split()
+
+    @property
+    def capability(self):
+        """Get the server capabilities"""
+        return " ".join(self.__capabilities)
+
+    @property
+    def capabilities(self) -> frozenset:
+        """Get the server capabilities as a set, see `IMAPMailbox.capabilities`"""
+        return frozenset(self.__capabilities)
+
+    async def add(self, message):
+        """Add a message to the mailbox"""
+
+        await self.__simple_command(
+            "APPEND",
+            imap_quote(self.__folder),
+            imaplib.Time2Internaldate(time.time()),
+            literal=message.as_bytes(),
+        )
+
+    async def copy(self, messageset: bytes, folder: str) -> None:
+        """Copy a message to a different folder"""
+        await self.__command("COPY", messageset, imap_quote(folder))
+
+    async def move(self, messageset: bytes, folder: str) -> None:
+        """Move a message to a different folder, see `IMAPMailbox.move`"""
+
+        if "MOVE" in self.__capabilities:
+            await self.__command("MOVE", messageset, imap_quote(folder))
+        else:
+            await self.copy(messageset, folder)
+            await self.remove(messageset)
+
+    async def discard(self, messageset: bytes) -> None:
+        """Mark messages for deletion"""
+        await self.__command("STORE", messageset, "+FLAGS", "(\\Deleted)")
+
+    async def remove(self, messageset: bytes) -> None:
+        """Remove messages from the mailbox"""
+
+        await self.discard(messageset)
+        if self.use_uid and "UIDPLUS" in self.__capabilities:
+            await self.__command("EXPUNGE", messageset)
+        else:
+            await self.__simple_command("EXPUNGE")
+
+    async def fetch(self, messageset: bytes, what):
+        """Fetch messages from the mailbox
+
+        Yields a tuple of UID and body for each message, see `fetch_items`.
+        """
+
+        async for uid, items in self.fetch_items(messageset, what):
+            body = fetch_body(items)
+            if body is not None:
+                yield str(uid), body
+
+    async def fetch_items(self, messageset: bytes, what):
+        """Fetch any mix of data items for messages in the mailbox
+
+        Yields a tuple of UID and a dict of data items for each message, see
+        `parse_fetch_response`. The whole response is read before the first
+        message is yielded, so other commands can be sent while iterating.
+        """
+
+        prefix = ("UID",) if self.use_uid else ()
+        messages = []
+        async with self.__lock:
+            tag = await self.__send(*prefix, "FETCH", messageset, what)
+            while True:
+                response_type, data = await self.__read_response()
+                if response_type == tag:
+                    break
+
+                if response_type != "FETCH":
+                    continue
+
+                for number, items in parse_fetch_response(data):
+                    if self.use_uid:
+                        if "UID" not in items:
+                            continue
+                        number = items["UID"]
+                    messages.append((number, items))
+
+        handle_response(self.__status(data))
+        for number, items in messages:
+            yield number, items
+
+    async def search(self, query):
+        """Search for messages matching the query
+
+        Supports the same search macros as `IMAPMailbox.search`.
+
+        Returns:
+            bytes: A comma-separated list of message UIDs
+        """
+
+        expanded_query = expand_search_macros(query)
+        data = await self.__command("SEARCH", expanded_query)
+        uids = b" ".join(data).split()
+
+        log.info(f"Searching for messages matching: {query}")
+        if expanded_query != query:
+            log.info(f"Expanded search query to: {expanded_query}")
+        log.info(f"Found {len(uids)} results")
+
+        return b",".join(uids)
+
+    async def list_folders(self):
+        """List all folders in the mailbox
+
+        Yields a tuple of flags, delimiter, folder name, and folder display name
+        for each folder.
+        """
+
+        data = await self.__simple_command("LIST", '""', '"*"')
+        for line in data.get("LIST", []):
+            flags, delimiter, folder = FOLDER_DATA_RE.match(line.decode()).groups()
+            display_name = folder.split(delimiter)[-1]
+            yield (flags, delimiter, folder, display_name)
+
     @property
     def current_folder(self):
         """Get the currently selected folder"""
         return self.__folder
 
-    def select(self, folder):
-        """Select a folder"""
+    @property
+    def uidvalidity(self):
+        """Get the UIDVALIDITY of the currently selected folder"""
+        return self.__uidvalidity
+
+    async def select(self, folder, readonly=None):
+        """Select a folder, see `IMAPMailbox.select`"""
+
+        if readonly is None:
+            readonly = self.readonly
+
         self.__folder = folder
-        self.__m.select(folder)
+        if self.__selected == (folder, readonly):
+            return self
+
+        self.__selected = None
+        command = "EXAMINE" if readonly else "SELECT"
+        data = await self.__simple_command(command, imap_quote(folder))
+        self.__selected = (folder, readonly)
+        uidvalidity = data.get("UIDVALIDITY", [None])[-1]
+        self.__uidvalidity = int(uidvalidity) if uidvalidity else None
         return self
+
+    async def __command(self, name, *args):
+        """Send a command, as its UID variant in UID mode, and get its data
+
+        Returns the untagged data of the response named like the command.
+        """
+
+        if self.use_uid:
+            data = await self.__simple_command("UID", name, *args)
+        else:
+            data = await self.__simple_command(name, *args)
+
+        return data.get(name, [])
+
+    async def __simple_command(self, *args, literal=None):
+        """Send a command and wait for its completion
+
+        Returns a dict that maps untagged response types, and response codes,
+        to the list of their data.
+        """
+
+        untagged = collections.defaultdict(list)
+        async with self.__lock:
+            tag = await self.__send(*args, literal=literal)
+            while True:
+                response_type, data = await self.__read_response()
+                if response_type == tag:
+                    break
+
+                if response_type in ("FETCH", "LIST", "SEARCH", "CAPABILITY"):
+                    untagged[response_type].extend(data)
+                elif isinstance(data[-1], bytes):
+                    untagged[response_type].append(data[-1])
+
+        status, text = self.__status(data)
+        handle_response((status, text))
+        code = RESPONSE_CODE_RE.match(text[0])
+        if code:
+            untagged[code.group(1).decode()].append(code.group(2))
+
+        return untagged
+
+    async def __send(self, *args, literal=None):
+        """Send a tagged command and return its tag"""
+
+        self.__tag += 1
+        tag = f"A{self.__tag:04d}"
+        line = " ".join(arg.decode() if isinstance(arg, bytes) else arg for arg in args)
+        command = f"{tag} {line}".encode()
+
+        if literal is None:
+            self.__writer.write(command + b"\r\n")
+        elif "LITERAL+" in self.__capabilities:
+            self.__writer.write(
+                command + b" {%d+}\r\n" % len(literal) + literal + b"\r\n"
+            )
+        else:
+            self.__writer.write(command + b" {%d}\r\n" % len(literal))
+            await self.__writer.drain()
+            while True:
+                response_type, data = await self.__read_response()
+                if response_type == "+":
+                    break
+                if response_type == tag:
+                    handle_response(self.__status(data))
+            self.__writer.write(literal + b"\r\n")
+
+        await self.__writer.drain()
+        return tag
+
+    async def __read_response(self):
+        """Read one response, with its literals, from the server
+
+        Returns the tag, "+" or the untagged response type, and the response
+        data in the format used by imaplib. The type and the message number of
+        untagged responses are removed, e.g. "* 2 FETCH (...)" becomes "2 (...)".
+        """
+
+        line = (await self.__reader.readuntil(b"\r\n"))[:-2]
+        data = []
+        while LITERAL_RE.search(line):
+            size = int(LITERAL_RE.search(line).group(1))
+            data.append((line, await self.__reader.readexactly(size)))
+            line = (await self.__reader.readuntil(b"\r\n"))[:-2]
+        data.append(line)
+
+        head = data[0][0] if isinstance(data[0], tuple) else data[0]
+        if head.startswith(b"+"):
+            return "+", data
+
+        match = RESPONSE_RE.match(head)
+        if match is None:
+            raise Exception(f"Unexpected response: {head!r}")
+
+        tag, number, response_type, rest = match.groups()
+
+        if tag != b"*":
+            data[0] = response_type + b" " + rest
+            return tag.decode(), data
+
+        response_type = response_type.decode().upper()
+        if response_type == "OK":
+            code = RESPONSE_CODE_RE.match(rest)
+            if code:
+                return code.group(1).decode(), [code.group(2)]
+
+        rest = number + b" " + rest if number else rest
+        if isinstance(data[0], tuple):
+            data[0] = (rest, data[0][1])
+        else:
+            data[0] = rest
+
+        return response_type, data
+
+    def __status(self, data):
+        """Get the status and text of a tagged response from its data"""
+
+        status, _, text = data[0].partition(b" ")
+        return status.decode().upper(), [text]
+
+
+def main(argv=None):
+    """Run the command line interface, see `python -m imap_mailbox --help`
+
+    The password is read from the IMAP_PASSWORD environment variable, or
+    prompted for when it is not set.
+    """
+
+    parser = argparse.ArgumentParser(prog="python -m imap_mailbox")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    mirror = commands.add_parser("mirror", help="mirror folders into a local Maildir")
+    mirror.add_argument("host")
+    mirror.add_argument("user")
+    mirror.add_argument("path", help="the Maildir to mirror into")
+    mirror.add_argument("folders", nargs="*", help="the folders, by default all")
+    mirror.add_argument("--port", type=int, default=993)
+    mirror.add_argument("--security", choices=("SSL", "STARTTLS"), default="SSL")
+    args = parser.parse_args(argv)
+
+    password = os.getenv("IMAP_PASSWORD") or getpass.getpass()
+    with IMAPMailbox(
+        args.host,
+        args.user,
+        password,
+        port=args.port,
+        security=args.security,
+        use_uid=True,
+        readonly=True,
+    ) as mailbox:
+        folders = args.folders or [
+            folder
+            for flags, _, folder, _ in mailbox.list_folders()
+            if "\\noselect" not in flags.lower()
+        ]
+        for folder, counts in mailbox.mirror(args.path, folders).items():
+            print(
+                f"{folder}: {counts['new']} new, {counts['changed']} changed, "
+                f"{counts['vanished']} vanished"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import imaplib
+import socketserver
+import threading
+
+import pytest
+
+import imap_mailbox
+
+
+class ScriptedIMAPServer(socketserver.ThreadingTCPServer):
+    """A plain text IMAP server that answers commands from a script
+
+    `script` maps command names, like "SELECT" or "UID FETCH", to functions
+    that are called with the command arguments and return the response lines.
+    Untagged lines start with "* ", the last line is the tagged status without
+    the tag, for example "OK done". Every command line is kept in `commands`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ScriptedIMAPHandler)
+        self.commands = []
+        self.script = {
+            "CAPABILITY": lambda args: ["* CAPABILITY IMAP4rev1", "OK done"],
+            "LOGIN": lambda args: ["OK [CAPABILITY IMAP4rev1] logged in"],
+            "SELECT": self.select,
+            "EXAMINE": self.select,
+            "NOOP": lambda args: ["OK done"],
+            "CLOSE": lambda args: ["OK done"],
+            "EXPUNGE": lambda args: ["OK done"],
+            "LOGOUT": lambda args: ["* BYE logging out", "OK done"],
+        }
+
+    @staticmethod
+    def select(args):
+        return [
+            "* 3 EXISTS",
+            "* OK [UIDVALIDITY 1] UIDs valid",
+            "* OK [UIDNEXT 4] predicted next UID",
+            "OK [READ-WRITE] done",
+        ]
+
+    def mailbox(self, **kwargs):
+        """Create a mailbox that connects to this server"""
+        return imap_mailbox.IMAPMailbox(
+            "127.0.0.1", "user", "password", port=self.server_address[1], **kwargs
+        )
+
+
+class ScriptedIMAPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"* OK ready\r\n")
+        for line in self.rfile:
+            line = line.decode().rstrip("\r\n")
+            self.server.commands.append(line)
+            tag, name, args = (line.split(" ", 2) + [""])[:3]
+            name = name.upper()
+            if name == "UID":
+                command, _, args = args.partition(" ")
+                name = f"UID {command.upper()}"
+
+            handler = self.server.script.get(name, lambda args: ["BAD unknown"])
+            *untagged, status = handler(args)
+            response = "".join(f"{line}\r\n" for line in untagged)
+            self.wfile.write(f"{response}{tag} {status}\r\n".encode())
+            if name == "LOGOUT":
+                return
+
+
+@pytest.fixture
+def imap_server(monkeypatch):
+    """Run a ScriptedIMAPServer that mailboxes connect to without SSL"""
+
+    server = ScriptedIMAPServer()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    monkeypatch.setattr(
+        imap_mailbox.imaplib,
+        "IMAP4_SSL",
+        lambda host, port, **kwargs: imaplib.IMAP4(host, port),
+    )
+    yield server
+    server.shutdown()
+    server.server_close()
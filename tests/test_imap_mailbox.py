@@ -0,0 +1,514 @@
+import asyncio
+import base64
+import imaplib
+import quopri
+
+import pytest
+
+import imap_mailbox
+
+
+def parse(data):
+    return list(imap_mailbox.parse_fetch_response(data))
+
+
+def test_parse_fetch_response_atoms_and_numbers():
+    data = [b'1 (UID 10 RFC822.SIZE 2048 INTERNALDATE "17-Jul-1996 02:44:25 -0700")']
+    assert parse(data) == [
+        (
+            1,
+            {
+                "UID": 10,
+                "RFC822.SIZE": 2048,
+                "INTERNALDATE": "17-Jul-1996 02:44:25 -0700",
+            },
+        )
+    ]
+
+
+def test_parse_fetch_response_literals():
+    data = [
+        (b"1 (UID 10 RFC822.HEADER {9}", b"Subject:\n"),
+        (b" RFC822.TEXT {4}", b"body"),
+        b")",
+    ]
+    assert parse(data) == [
+        (1, {"UID": 10, "RFC822.HEADER": b"Subject:\n", "RFC822.TEXT": b"body"})
+    ]
+
+
+def test_parse_fetch_response_literal_size_mismatch():
+    with pytest.raises(Exception, match="Size mismatch"):
+        parse([(b"1 (RFC822 {10}", b"short"), b")"])
+
+
+def test_parse_fetch_response_several_messages():
+    data = [
+        (b"1 (UID 10 RFC822 {1}", b"a"),
+        b")",
+        (b"2 (UID 11 RFC822 {1}", b"b"),
+        b")",
+        None,
+    ]
+    assert parse(data) == [
+        (1, {"UID": 10, "RFC822": b"a"}),
+        (2, {"UID": 11, "RFC822": b"b"}),
+    ]
+
+
+def test_parse_fetch_response_nil():
+    data = [b"1 (UID 10 BODY[] NIL X-GM-LABELS nil)"]
+    assert parse(data) == [(1, {"UID": 10, "BODY[]": None, "X-GM-LABELS": None})]
+
+
+def test_parse_fetch_response_nested_lists():
+    data = [
+        b'1 (FLAGS (\\Seen \\Answered) BODYSTRUCTURE (("TEXT" "PLAIN" '
+        b'("CHARSET" "utf-8") NIL NIL "7BIT" 5 1) "MIXED"))'
+    ]
+    assert parse(data) == [
+        (
+            1,
+            {
+                "FLAGS": ["\\Seen", "\\Answered"],
+                "BODYSTRUCTURE": [
+                    ["TEXT", "PLAIN", ["CHARSET", "utf-8"], None, None, "7BIT", 5, 1],
+                    "MIXED",
+                ],
+            },
+        )
+    ]
+
+
+def test_parse_fetch_response_empty_list():
+    assert parse([b"1 (FLAGS ())"]) == [(1, {"FLAGS": []})]
+
+
+def test_parse_fetch_response_quoted_escapes():
+    data = [b'1 (ENVELOPE (NIL "say \\"hi\\" C:\\\\temp"))']
+    assert parse(data) == [(1, {"ENVELOPE": [None, 'say "hi" C:\\temp']})]
+
+
+def test_parse_fetch_response_header_fields_name():
+    data = [(b"1 (UID 10 BODY[HEADER.FIELDS (SUBJECT FROM)] {9}", b"Subject:\n"), b")"]
+    assert parse(data) == [
+        (1, {"UID": 10, "BODY[HEADER.FIELDS (SUBJECT FROM)]": b"Subject:\n"})
+    ]
+
+
+def test_parse_fetch_response_partial_suffix():
+    data = [(b"1 (UID 10 BODY[]<0> {4}", b"From"), b")"]
+    assert parse(data) == [(1, {"UID": 10, "BODY[]<0>": b"From"})]
+
+
+def test_parse_fetch_response_names_are_upper_cased():
+    assert parse([b"1 (uid 10 flags ())"]) == [(1, {"UID": 10, "FLAGS": []})]
+
+
+@pytest.mark.parametrize(
+    "uids, expected",
+    [
+        ([], b""),
+        (["5"], b"5"),
+        (["1", "2", "3", "5"], b"1:3,5"),
+        ([1, 3, 4, 5, 7, 8], b"1,3:5,7:8"),
+        (["3", "1", "2"], b"3,1:2"),
+    ],
+)
+def test_sequence_set(uids, expected):
+    assert imap_mailbox.sequence_set(uids) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        (b"", []),
+        (b"5", ["5"]),
+        (b"1:3,5", ["1", "2", "3", "5"]),
+        ("3:1", ["1", "2", "3"]),
+        (b"1,,2", ["1", "2"]),
+    ],
+)
+def test_parse_sequence_set(text, expected):
+    assert imap_mailbox.parse_sequence_set(text) == expected
+
+
+def test_sequence_set_round_trip():
+    uids = ["1", "2", "3", "7", "9", "10"]
+    assert imap_mailbox.parse_sequence_set(imap_mailbox.sequence_set(uids)) == uids
+
+
+def chunks(data, size):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 4, 7, 1000])
+def test_decode_transfer_encoding_base64(size):
+    payload = bytes(range(256)) * 3
+    encoded = base64.encodebytes(payload)
+    decoded = imap_mailbox.decode_transfer_encoding(chunks(encoded, size), "base64")
+    assert b"".join(decoded) == payload
+
+
+def test_decode_transfer_encoding_base64_missing_padding():
+    decoded = imap_mailbox.decode_transfer_encoding([b"aGk"], "BASE64")
+    assert b"".join(decoded) == b"hi"
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 1000])
+def test_decode_transfer_encoding_quoted_printable(size):
+    payload = "caf\xe9 = na\xefve\n".encode("latin-1") * 20 + b"x" * 100
+    encoded = quopri.encodestring(payload)
+    decoded = imap_mailbox.decode_transfer_encoding(
+        chunks(encoded, size), "quoted-printable"
+    )
+    assert b"".join(decoded) == payload
+
+
+@pytest.mark.parametrize("encoding", [None, "7bit", "8bit", "binary"])
+def test_decode_transfer_encoding_passthrough(encoding):
+    assert list(imap_mailbox.decode_transfer_encoding([b"a", b"b"], encoding)) == [
+        b"a",
+        b"b",
+    ]
+
+
+def test_failed_select_gives_back_the_pool_slot(imap_server):
+    select = imap_server.script["SELECT"]
+    imap_server.script["SELECT"] = lambda args: (
+        ["NO no such folder"] if "Missing" in args else select(args)
+    )
+    pool = imap_mailbox.IMAPConnectionPool(max_per_account=1, timeout=1)
+
+    for _ in range(2):
+        with pytest.raises(Exception, match="no such folder"):
+            imap_server.mailbox(pool=pool, folder="Missing").connect()
+
+    with imap_server.mailbox(pool=pool) as mailbox:
+        assert mailbox.uidvalidity == 1
+    pool.close()
+
+
+def test_disconnect_without_a_selected_folder(imap_server):
+    pool = imap_mailbox.IMAPConnectionPool()
+    mailbox = imap_server.mailbox(pool=pool)
+    mailbox.connect()
+    imap_server.script["SELECT"] = lambda args: ["NO no such folder"]
+    with pytest.raises(Exception, match="no such folder"):
+        mailbox.select("Missing")
+
+    mailbox.disconnect()
+    assert not [command for command in imap_server.commands if "EXPUNGE" in command]
+    pool.close()
+
+
+def fetch_messages(args):
+    numbers, _, what = args.partition(" ")
+    if what != "RFC822":
+        return ["BAD unknown data item"]
+    return [
+        f"* {number} FETCH (UID {number} RFC822 {{5}}\r\nbody{number})"
+        for number in imap_mailbox.parse_sequence_set(numbers)
+    ] + ["OK done"]
+
+
+def test_pipeline_reads_every_response_before_raising(imap_server):
+    imap_server.script["FETCH"] = fetch_messages
+    with imap_server.mailbox() as mailbox:
+        with pytest.raises(imaplib.IMAP4.error, match="unknown data item"):
+            mailbox.pipeline(("FETCH", b"1", "(BOGUS)"), ("FETCH", b"2:3", "RFC822"))
+
+        assert list(mailbox.fetch(b"3", "RFC822")) == [("3", b"body3")]
+
+
+def fetch_lazy(args):
+    numbers, _, what = args.partition(" ")
+    numbers = imap_mailbox.parse_sequence_set(numbers)
+    if what == "BODY.PEEK[]":
+        lines = [f"* {n} FETCH (BODY[] {{5}}\r\nbody{n})" for n in numbers]
+    else:
+        lines = [f"* {n} FETCH (UID {n} RFC822.SIZE 5 FLAGS ())" for n in numbers]
+    return lines + ["OK done"]
+
+
+@pytest.mark.parametrize(
+    "prefetch_bytes, command",
+    [(0, "FETCH 1 BODY.PEEK[]"), (10, "FETCH 1:3 BODY.PEEK[]")],
+)
+def test_proxy_bodies_are_peeked_and_prefetched(imap_server, prefetch_bytes, command):
+    imap_server.script["SEARCH"] = lambda args: ["* SEARCH 1 2 3 4", "OK done"]
+    imap_server.script["FETCH"] = fetch_lazy
+    with imap_server.mailbox(lazy=True, prefetch_bytes=prefetch_bytes) as mailbox:
+        proxies = list(mailbox.values())
+        assert proxies[0].get_payload() == "body1"
+
+    commands = [line.split(" ", 1)[1] for line in imap_server.commands]
+    assert [line for line in commands if "BODY" in line] == [command]
+
+
+def fetch_sized(args):
+    numbers, _, what = args.partition(" ")
+    numbers = imap_mailbox.parse_sequence_set(numbers)
+    sizes = {"1": 3, "2": 3, "3": 6, "4": 1}
+    if what == "(UID RFC822.SIZE)":
+        lines = [f"* {n} FETCH (UID {n} RFC822.SIZE {sizes[n]})" for n in numbers]
+    else:
+        lines = [f"* {n} FETCH (RFC822 {{5}}\r\nbody{n})" for n in numbers]
+    return lines + ["OK done"]
+
+
+@pytest.mark.parametrize(
+    "batch_size, batch_bytes, batches",
+    [
+        (500, None, ["1:4"]),
+        (2, None, ["1:2", "3:4"]),
+        (500, 6, ["1:2", "3", "4"]),
+        (500, 2, ["1", "2", "3", "4"]),
+        (None, None, ["1", "2", "3", "4"]),
+    ],
+)
+def test_items_batches(imap_server, batch_size, batch_bytes, batches):
+    imap_server.script["SEARCH"] = lambda args: ["* SEARCH 1 2 3 4", "OK done"]
+    imap_server.script["FETCH"] = fetch_sized
+    options = {"batch_size": batch_size, "batch_bytes": batch_bytes}
+    with imap_server.mailbox(**options) as mailbox:
+        assert [key for key, message in mailbox.items()] == ["1", "2", "3", "4"]
+
+    fetches = [
+        line.split()[2] for line in imap_server.commands if line.endswith(" RFC822")
+    ]
+    assert fetches == batches
+
+
+def test_async_capabilities_match_the_sync_surface(imap_server, monkeypatch):
+    imap_server.script["LOGIN"] = lambda args: [
+        "OK [CAPABILITY IMAP4rev1 MOVE] logged in"
+    ]
+    monkeypatch.setattr(imap_mailbox.ssl, "create_default_context", lambda: None)
+
+    async def capabilities():
+        port = imap_server.server_address[1]
+        mailbox = imap_mailbox.AsyncIMAPMailbox("127.0.0.1", "u", "p", port=port)
+        async with mailbox:
+            return mailbox.capability, mailbox.capabilities
+
+    with imap_server.mailbox() as mailbox:
+        expected = mailbox.capability, mailbox.capabilities
+
+    assert (
+        asyncio.run(capabilities())
+        == expected
+        == (
+            "IMAP4REV1 MOVE",
+            frozenset({"IMAP4REV1", "MOVE"}),
+        )
+    )
+
+
+def test_message_cache_evicts_least_recently_used():
+    cache = imap_mailbox.MessageCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == cache.get("c") == b"1234"
+    assert (cache.size, cache.hits, cache.misses) == (8, 3, 1)
+
+
+def test_message_cache_skips_bodies_larger_than_the_cache():
+    cache = imap_mailbox.MessageCache(max_bytes=3)
+    cache.put("a", b"1234")
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+
+def test_message_cache_invalidate():
+    cache = imap_mailbox.MessageCache()
+    for folder in ("INBOX", "Archive"):
+        for uid in ("1", "2"):
+            cache.put((folder, uid, "RFC822"), b"body")
+
+    cache.invalidate("INBOX", {"1"})
+    assert cache.get(("INBOX", "1", "RFC822")) is None
+    assert cache.get(("INBOX", "2", "RFC822")) == b"body"
+
+    cache.invalidate("Archive")
+    assert cache.get(("Archive", "2", "RFC822")) is None
+    assert cache.size == 4
+
+    cache.clear()
+    assert cache.get(("INBOX", "2", "RFC822")) is None
+    assert cache.size == 0
+
+
+def test_message_cache_is_dropped_on_store(imap_server):
+    imap_server.script["UID FETCH"] = fetch_messages
+    imap_server.script["UID STORE"] = lambda args: ["OK done"]
+    cache = imap_mailbox.MessageCache()
+    with imap_server.mailbox(use_uid=True, message_cache=cache) as mailbox:
+        for _ in range(2):
+            assert list(mailbox.fetch(b"2", "RFC822")) == [("2", b"body2")]
+        mailbox.discard(b"1:2")
+        assert list(mailbox.fetch(b"2", "RFC822")) == [("2", b"body2")]
+
+    fetches = [line for line in imap_server.commands if "UID FETCH" in line]
+    assert len(fetches) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_message_cache_requires_uids():
+    with pytest.raises(ValueError):
+        imap_mailbox.IMAPMailbox(
+            "host", "user", "password", message_cache=imap_mailbox.MessageCache()
+        )
+
+
+def test_message_headers_are_decoded_once(monkeypatch):
+    message = imap_mailbox.IMAPMessage(
+        b"Subject: =?utf-8?q?caf=C3=A9?=\r\nFrom: plain@example.com\r\n\r\nbody"
+    )
+    calls = []
+    decode_header = imap_mailbox.email.header.decode_header
+    monkeypatch.setattr(
+        imap_mailbox.email.header,
+        "decode_header",
+        lambda value: calls.append(value) or decode_header(value),
+    )
+
+    assert message["Subject"] == message["Subject"] == "café"
+    assert message["From"] == "plain@example.com"
+    assert message["X-Missing"] is None
+    assert calls == ["=?utf-8?q?caf=C3=A9?="]
+
+
+def test_message_header_memo_follows_changes():
+    message = imap_mailbox.IMAPMessage(b"Subject: =?utf-8?q?one?=\r\n\r\nbody")
+    assert message["Subject"] == "one"
+
+    message.replace_header("Subject", "=?utf-8?q?two?=")
+    assert message["Subject"] == "two"
+
+
+class SyncFolder:
+    """A folder with flags and mod-sequences, scripted into an imap_server"""
+
+    def __init__(self, server, capabilities):
+        self.messages = {1: ["\\Seen"], 2: [], 3: []}
+        self.modseqs = {1: 1, 2: 2, 3: 3}
+        self.expunged = {}
+        self.highestmodseq = 3
+        self.uidnext = 4
+        self.capabilities = capabilities
+        capability = f"CAPABILITY IMAP4rev1 ENABLE {' '.join(capabilities)}"
+        server.script["CAPABILITY"] = lambda args: [f"* {capability}", "OK done"]
+        server.script["LOGIN"] = lambda args: [f"OK [{capability}] logged in"]
+        server.script["ENABLE"] = lambda args: ["* ENABLED QRESYNC", "OK done"]
+        server.script["SELECT"] = self.select
+        server.script["UID FETCH"] = self.fetch
+        server.script["UID SEARCH"] = self.search
+
+    def select(self, args):
+        lines = [
+            f"* {len(self.messages)} EXISTS",
+            "* OK [UIDVALIDITY 7] UIDs valid",
+            f"* OK [UIDNEXT {self.uidnext}] predicted next UID",
+        ]
+        if "CONDSTORE" in self.capabilities:
+            lines.append(f"* OK [HIGHESTMODSEQ {self.highestmodseq}] modseq")
+        return lines + ["OK [READ-WRITE] done"]
+
+    def fetch(self, args):
+        changedsince = 0
+        if "CHANGEDSINCE" in args:
+            changedsince = int(args.split("CHANGEDSINCE ")[1].split()[0].rstrip(")"))
+
+        lines = []
+        for number, uid in enumerate(sorted(self.messages), 1):
+            if self.modseqs[uid] > changedsince:
+                flags = " ".join(self.messages[uid])
+                lines.append(f"* {number} FETCH (UID {uid} FLAGS ({flags}))")
+
+        vanished = [
+            uid for uid, modseq in self.expunged.items() if modseq > changedsince
+        ]
+        if "VANISHED" in args and vanished:
+            lines.insert(
+                0,
+                f"* VANISHED (EARLIER) {imap_mailbox.sequence_set(vanished).decode()}",
+            )
+        return lines + ["OK done"]
+
+    def search(self, args):
+        return [f"* SEARCH {' '.join(map(str, sorted(self.messages)))}", "OK done"]
+
+    def change(self, uid, flags=None, expunge=False, append=False):
+        """Change a message the way another client would"""
+
+        self.highestmodseq += 1
+        if expunge:
+            del self.messages[uid]
+            self.expunged[uid] = self.highestmodseq
+        elif append:
+            self.messages[uid] = []
+            self.uidnext = uid + 1
+        else:
+            self.messages[uid] = flags
+        if uid in self.messages:
+            self.modseqs[uid] = self.highestmodseq
+
+
+@pytest.mark.parametrize("capabilities", [[], ["CONDSTORE"], ["CONDSTORE", "QRESYNC"]])
+def test_sync(imap_server, capabilities):
+    folder = SyncFolder(imap_server, capabilities)
+    with imap_server.mailbox(use_uid=True) as mailbox:
+        first = mailbox.sync()
+        assert first["reset"] is True
+        assert first["new"] == {"1": ["\\Seen"], "2": [], "3": []}
+
+        second = mailbox.sync(first["state"])
+        assert (second["new"], second["changed"], second["vanished"]) == ({}, {}, [])
+
+        folder.change(2, ["\\Flagged"])
+        folder.change(3, expunge=True)
+        folder.change(4, append=True)
+        third = mailbox.sync(second["state"])
+        assert third["reset"] is False
+        assert third["new"] == {"4": []}
+        assert third["changed"] == {"2": ["\\Flagged"]}
+        assert third["vanished"] == ["3"]
+
+    searches = [line for line in imap_server.commands if "UID SEARCH" in line]
+    # QRESYNC servers report expunges, CONDSTORE ones need the UIDs compared
+    assert len(searches) == (1 if capabilities == ["CONDSTORE"] else 0)
+
+
+def test_sync_sends_nothing_more_when_nothing_changed(imap_server):
+    SyncFolder(imap_server, ["CONDSTORE"])
+    with imap_server.mailbox(use_uid=True) as mailbox:
+        state = mailbox.sync()["state"]
+        count = len(imap_server.commands)
+        mailbox.sync(state)
+
+    commands = [line.split()[1] for line in imap_server.commands[count:]]
+    assert commands[:1] == ["SELECT"]
+    assert "UID" not in commands
+
+
+def test_sync_finds_expunges_without_qresync(imap_server):
+    # only QRESYNC servers have to raise HIGHESTMODSEQ on expunge
+    folder = SyncFolder(imap_server, ["CONDSTORE"])
+    with imap_server.mailbox(use_uid=True) as mailbox:
+        state = mailbox.sync()["state"]
+        del folder.messages[2]
+        assert mailbox.sync(state)["vanished"] == ["2"]
+
+
+def test_sync_reset_on_uidvalidity_change(imap_server):
+    SyncFolder(imap_server, [])
+    with imap_server.mailbox(use_uid=True) as mailbox:
+        state = dict(mailbox.sync()["state"], uidvalidity=6)
+        result = mailbox.sync(state)
+    assert result["reset"] is True
+    assert sorted(result["new"]) == ["1", "2", "3"]